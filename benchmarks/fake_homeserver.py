@@ -0,0 +1,631 @@
+"""
+A fake Matrix homeserver for load and performance testing Bubo without Synapse.
+
+Serves the client-server API endpoints Bubo uses through matrix-nio and directly,
+as well as the Synapse admin API endpoints used in `bubo.synapse_admin`. State is kept
+in memory. Responses can be slowed down with a configurable latency, and a share of
+requests can be rate limited with 429 responses.
+
+Usage:
+
+    python -m benchmarks.fake_homeserver --port 8008 --rooms 1000 --members 20 \\
+        --latency-ms 20 --ratelimit 0.05 --database /tmp/bubo.db
+
+Then point `matrix.homeserver_url` of a Bubo config at http://127.0.0.1:8008, with
+`server_name` matching `--server-name`. Any access token is accepted as the bot user.
+With `--database`, the seeded rooms are also stored in a Bubo database so that Bubo
+maintains them.
+
+The server can also be started from Python, for example in benchmarks:
+
+    server = FakeHomeserver(server_name="example.com", latency=0.01)
+    server.seed_rooms(1000, members=20)
+    runner = await server.start(port=8008)
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import time
+import uuid
+from copy import deepcopy
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+CLIENT_PREFIXES = ("/_matrix/client/r0", "/_matrix/client/v3")
+ADMIN_PREFIX = "/_synapse/admin/v1"
+
+DEFAULT_POWER_LEVELS = {
+    "ban": 50,
+    "events": {
+        "m.room.avatar": 50,
+        "m.room.canonical_alias": 50,
+        "m.room.encryption": 100,
+        "m.room.history_visibility": 100,
+        "m.room.name": 50,
+        "m.room.power_levels": 100,
+        "m.room.server_acl": 100,
+        "m.room.tombstone": 100,
+    },
+    "events_default": 0,
+    "invite": 0,
+    "kick": 50,
+    "redact": 50,
+    "state_default": 50,
+    "users": {},
+    "users_default": 0,
+}
+
+
+def error(status: int, errcode: str, message: str, **kwargs) -> web.Response:
+    return web.json_response({"errcode": errcode, "error": message, **kwargs}, status=status)
+
+
+class FakeRoom:
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.state: Dict[Tuple[str, str], Dict] = {}
+        self.timeline: List[Tuple[int, Dict]] = []
+        self.visibility = "private"
+        self.tags: Dict[str, Dict] = {}
+
+    @property
+    def members(self) -> Set[str]:
+        return self.members_with("join")
+
+    @property
+    def invited(self) -> Set[str]:
+        return self.members_with("invite")
+
+    def members_with(self, membership: str) -> Set[str]:
+        return {
+            state_key for (event_type, state_key), event in self.state.items()
+            if event_type == "m.room.member" and event["content"].get("membership") == membership
+        }
+
+    def get_state(self, event_type: str, state_key: str = "") -> Optional[Dict]:
+        event = self.state.get((event_type, state_key))
+        return event["content"] if event else None
+
+
+class FakeHomeserver:
+    def __init__(
+        self, server_name: str = "example.com", user_id: str = None, latency: float = 0.0,
+        jitter: float = 0.0, ratelimit: float = 0.0, retry_after_ms: int = 500,
+    ):
+        self.server_name = server_name
+        self.user_id = user_id or f"@bubo:{server_name}"
+        self.latency = latency
+        self.jitter = jitter
+        self.ratelimit = ratelimit
+        self.retry_after_ms = retry_after_ms
+        self.rooms: Dict[str, FakeRoom] = {}
+        self.aliases: Dict[str, str] = {}
+        self.tokens: Dict[str, str] = {}
+        self.stream = itertools.count(1)
+        self.position = 0
+        self.new_events = asyncio.Condition()
+        self.requests = 0
+        self.throttled = 0
+
+    # Server state
+
+    def new_id(self, sigil: str) -> str:
+        return f"{sigil}{uuid.uuid4().hex[:18]}:{self.server_name}"
+
+    def add_event(self, room: FakeRoom, sender: str, event_type: str, content: Dict, state_key: str = None) -> str:
+        event = {
+            "content": content,
+            "event_id": f"${uuid.uuid4().hex}",
+            "origin_server_ts": int(time.time() * 1000),
+            "room_id": room.room_id,
+            "sender": sender,
+            "type": event_type,
+            "unsigned": {},
+        }
+        if state_key is not None:
+            event["state_key"] = state_key
+            room.state[(event_type, state_key)] = event
+        self.position = next(self.stream)
+        room.timeline.append((self.position, event))
+        return event["event_id"]
+
+    async def notify(self):
+        async with self.new_events:
+            self.new_events.notify_all()
+
+    def create_room(
+        self, creator: str, name: str = None, alias: str = None, topic: str = None, encrypted: bool = False,
+        space: bool = False, power_level_override: Dict = None, initial_state: List[Dict] = None,
+        public: bool = False, members: List[str] = None,
+    ) -> FakeRoom:
+        room = FakeRoom(self.new_id("!"))
+        self.rooms[room.room_id] = room
+        create = {"creator": creator, "room_version": "9"}
+        if space:
+            create["type"] = "m.space"
+        self.add_event(room, creator, "m.room.create", create, "")
+        self.add_event(room, creator, "m.room.member", {"membership": "join"}, creator)
+        power_levels = deepcopy(DEFAULT_POWER_LEVELS)
+        power_levels["users"] = {creator: 100}
+        power_levels.update(power_level_override or {})
+        self.add_event(room, creator, "m.room.power_levels", power_levels, "")
+        self.add_event(room, creator, "m.room.join_rules", {"join_rule": "public" if public else "invite"}, "")
+        if name:
+            self.add_event(room, creator, "m.room.name", {"name": name}, "")
+        if topic:
+            self.add_event(room, creator, "m.room.topic", {"topic": topic}, "")
+        if alias:
+            full_alias = f"#{alias}:{self.server_name}"
+            self.aliases[full_alias] = room.room_id
+            self.add_event(room, creator, "m.room.canonical_alias", {"alias": full_alias}, "")
+        if encrypted:
+            self.add_event(room, creator, "m.room.encryption", {"algorithm": "m.megolm.v1.aes-sha2"}, "")
+        for event in initial_state or []:
+            self.add_event(room, creator, event["type"], event.get("content", {}), event.get("state_key", ""))
+        for member in members or []:
+            self.add_event(room, member, "m.room.member", {"membership": "join"}, member)
+        if public:
+            room.visibility = "public"
+        return room
+
+    def seed_rooms(self, count: int, members: int = 10, prefix: str = "room", encrypted_share: float = 0.5):
+        """
+        Create rooms joined by the bot, each with `members` other local users.
+
+        Every tenth room is a space. Room aliases are `#{prefix}{i}:{server_name}`.
+        """
+        users = [f"@user{i}:{self.server_name}" for i in range(max(members, 1) * 10)]
+        for i in range(count):
+            self.create_room(
+                self.user_id,
+                name=f"Room {i}",
+                alias=f"{prefix}{i}",
+                encrypted=random.random() < encrypted_share,
+                space=i % 10 == 0,
+                members=random.sample(users, members),
+            )
+        logger.info("Seeded %s rooms with %s members each", count, members)
+
+    async def seed_database(self, database_filepath: str):
+        """
+        Store seeded rooms with an alias in a Bubo database, so that Bubo maintains them.
+        """
+        from bubo.storage import Storage
+
+        rows = []
+        for room in self.rooms.values():
+            canonical = room.get_state("m.room.canonical_alias") or {}
+            if not canonical.get("alias"):
+                continue
+            create = room.get_state("m.room.create") or {}
+            rows.append((
+                (room.get_state("m.room.name") or {}).get("name"),
+                canonical["alias"].split(":")[0].strip("#"),
+                room.room_id,
+                "",
+                room.get_state("m.room.encryption") is not None,
+                room.visibility == "public",
+                "space" if create.get("type") == "m.space" else "room",
+            ))
+        store = Storage(database_filepath)
+        await store.store_rooms(rows)
+        logger.info("Stored %s rooms to %s", len(rows), database_filepath)
+
+    # Middleware
+
+    def requester(self, request: web.Request) -> str:
+        token = request.query.get("access_token")
+        authorization = request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[7:]
+        return self.tokens.get(token, self.user_id)
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        self.requests += 1
+        is_sync = request.path.endswith("/sync")
+        if not is_sync:
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay:
+                await asyncio.sleep(delay)
+            if self.ratelimit and random.random() < self.ratelimit:
+                self.throttled += 1
+                return error(429, "M_LIMIT_EXCEEDED", "Too Many Requests", retry_after_ms=self.retry_after_ms)
+        return await handler(request)
+
+    def get_room(self, request: web.Request, user_id: str = None) -> FakeRoom:
+        room = self.rooms.get(request.match_info["room_id"])
+        if not room:
+            raise web.HTTPNotFound(
+                text='{"errcode": "M_NOT_FOUND", "error": "Unknown room"}', content_type="application/json",
+            )
+        if user_id and user_id not in room.members:
+            raise web.HTTPForbidden(
+                text='{"errcode": "M_FORBIDDEN", "error": "Not in room"}', content_type="application/json",
+            )
+        return room
+
+    # Client-server API
+
+    async def versions(self, _request: web.Request) -> web.Response:
+        return web.json_response({"versions": ["r0.6.1", "v1.1", "v1.2", "v1.3"]})
+
+    async def login(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        user = body.get("identifier", {}).get("user") or body.get("user") or self.user_id
+        user_id = user if user.startswith("@") else f"@{user}:{self.server_name}"
+        token = uuid.uuid4().hex
+        self.tokens[token] = user_id
+        return web.json_response({
+            "access_token": token,
+            "device_id": body.get("device_id") or uuid.uuid4().hex[:10].upper(),
+            "user_id": user_id,
+        })
+
+    async def sync(self, request: web.Request) -> web.Response:
+        user_id = self.requester(request)
+        since = int(request.query.get("since", 0) or 0)
+        full_state = request.query.get("full_state") == "true" or not since
+        timeout = int(request.query.get("timeout", 0)) / 1000
+        if not full_state and self.position <= since and timeout:
+            async with self.new_events:
+                try:
+                    await asyncio.wait_for(self.new_events.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        joined = {}
+        invited = {}
+        for room in self.rooms.values():
+            if user_id in room.members:
+                events = [event for position, event in room.timeline if position > since]
+                if not events and not full_state:
+                    continue
+                joined[room.room_id] = {
+                    "state": {"events": list(room.state.values()) if full_state else []},
+                    "timeline": {"events": events[-50:], "limited": len(events) > 50, "prev_batch": str(since)},
+                    "ephemeral": {"events": []},
+                    "account_data": {"events": []},
+                    "summary": {"m.joined_member_count": len(room.members)},
+                }
+            elif user_id in room.invited:
+                invited[room.room_id] = {"invite_state": {"events": [
+                    event for (event_type, _key), event in room.state.items() if event_type != "m.room.member"
+                ] + [room.state[("m.room.member", user_id)]]}}
+        return web.json_response({
+            "next_batch": str(self.position),
+            "rooms": {"join": joined, "invite": invited, "leave": {}},
+            "to_device": {"events": []},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {"signed_curve25519": 50},
+        })
+
+    async def handle_create_room(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        creation_content = body.get("creation_content") or {}
+        room = self.create_room(
+            self.requester(request),
+            name=body.get("name"),
+            alias=body.get("room_alias_name"),
+            topic=body.get("topic"),
+            space=creation_content.get("type") == "m.space",
+            power_level_override=body.get("power_level_content_override"),
+            initial_state=body.get("initial_state"),
+            public=body.get("visibility") == "public",
+        )
+        for user_id in body.get("invite", []):
+            self.add_event(room, self.requester(request), "m.room.member", {"membership": "invite"}, user_id)
+        await self.notify()
+        return web.json_response({"room_id": room.room_id})
+
+    async def get_state(self, request: web.Request) -> web.Response:
+        room = self.get_room(request)
+        return web.json_response(list(room.state.values()))
+
+    async def get_state_event(self, request: web.Request) -> web.Response:
+        room = self.get_room(request)
+        content = room.get_state(request.match_info["event_type"], request.match_info.get("state_key", ""))
+        if content is None:
+            return error(404, "M_NOT_FOUND", "Event not found")
+        return web.json_response(content)
+
+    async def put_state_event(self, request: web.Request) -> web.Response:
+        user_id = self.requester(request)
+        room = self.get_room(request, user_id)
+        event_type = request.match_info["event_type"]
+        power_levels = room.get_state("m.room.power_levels") or {}
+        required = power_levels.get("events", {}).get(event_type, power_levels.get("state_default", 50))
+        if power_levels.get("users", {}).get(user_id, power_levels.get("users_default", 0)) < required:
+            return error(403, "M_FORBIDDEN", "Insufficient power level")
+        event_id = self.add_event(
+            room, user_id, event_type, await request.json(), request.match_info.get("state_key", ""),
+        )
+        await self.notify()
+        return web.json_response({"event_id": event_id})
+
+    async def send(self, request: web.Request) -> web.Response:
+        user_id = self.requester(request)
+        room = self.get_room(request, user_id)
+        event_id = self.add_event(room, user_id, request.match_info["event_type"], await request.json())
+        await self.notify()
+        return web.json_response({"event_id": event_id})
+
+    async def invite(self, request: web.Request) -> web.Response:
+        user_id = self.requester(request)
+        room = self.get_room(request, user_id)
+        invitee = (await request.json()).get("user_id")
+        if invitee in room.members:
+            return error(403, "M_FORBIDDEN", f"{invitee} is already in the room.")
+        self.add_event(room, user_id, "m.room.member", {"membership": "invite"}, invitee)
+        await self.notify()
+        return web.json_response({})
+
+    def join_room(self, room_id_or_alias: str, user_id: str) -> Optional[FakeRoom]:
+        room = self.rooms.get(self.aliases.get(room_id_or_alias, room_id_or_alias))
+        if not room:
+            return None
+        if user_id not in room.members:
+            self.add_event(room, user_id, "m.room.member", {"membership": "join"}, user_id)
+        return room
+
+    async def join(self, request: web.Request) -> web.Response:
+        room = self.join_room(request.match_info["room_id_or_alias"], self.requester(request))
+        if not room:
+            return error(404, "M_NOT_FOUND", "Unknown room")
+        await self.notify()
+        return web.json_response({"room_id": room.room_id})
+
+    async def join_by_room_id(self, request: web.Request) -> web.Response:
+        room = self.join_room(request.match_info["room_id"], self.requester(request))
+        if not room:
+            return error(404, "M_NOT_FOUND", "Unknown room")
+        await self.notify()
+        return web.json_response({"room_id": room.room_id})
+
+    async def leave(self, request: web.Request) -> web.Response:
+        user_id = self.requester(request)
+        room = self.get_room(request)
+        self.add_event(room, user_id, "m.room.member", {"membership": "leave"}, user_id)
+        await self.notify()
+        return web.json_response({})
+
+    async def joined_members(self, request: web.Request) -> web.Response:
+        room = self.get_room(request, self.requester(request))
+        return web.json_response({"joined": {
+            user_id: {"display_name": None, "avatar_url": None} for user_id in room.members
+        }})
+
+    async def resolve_alias(self, request: web.Request) -> web.Response:
+        room_id = self.aliases.get(request.match_info["alias"])
+        if not room_id:
+            return error(404, "M_NOT_FOUND", "Room alias not found")
+        return web.json_response({"room_id": room_id, "servers": [self.server_name]})
+
+    async def put_alias(self, request: web.Request) -> web.Response:
+        alias = request.match_info["alias"]
+        if alias in self.aliases:
+            return error(409, "M_UNKNOWN", "Room alias already exists")
+        self.aliases[alias] = (await request.json())["room_id"]
+        return web.json_response({})
+
+    async def delete_alias(self, request: web.Request) -> web.Response:
+        if not self.aliases.pop(request.match_info["alias"], None):
+            return error(404, "M_NOT_FOUND", "Room alias not found")
+        return web.json_response({})
+
+    async def get_visibility(self, request: web.Request) -> web.Response:
+        return web.json_response({"visibility": self.get_room(request).visibility})
+
+    async def put_visibility(self, request: web.Request) -> web.Response:
+        self.get_room(request).visibility = (await request.json()).get("visibility", "private")
+        return web.json_response({})
+
+    async def profile(self, request: web.Request) -> web.Response:
+        user_id = request.match_info["user_id"]
+        if not user_id.endswith(f":{self.server_name}"):
+            return error(404, "M_NOT_FOUND", "Profile not found")
+        return web.json_response({"displayname": user_id.split(":")[0].strip("@")})
+
+    async def get_tags(self, request: web.Request) -> web.Response:
+        return web.json_response({"tags": self.get_room(request).tags.get(request.match_info["user_id"], {})})
+
+    async def put_tag(self, request: web.Request) -> web.Response:
+        tags = self.get_room(request).tags.setdefault(request.match_info["user_id"], {})
+        tags[request.match_info["tag"]] = await request.json()
+        return web.json_response({})
+
+    async def delete_tag(self, request: web.Request) -> web.Response:
+        self.get_room(request).tags.get(request.match_info["user_id"], {}).pop(request.match_info["tag"], None)
+        return web.json_response({})
+
+    async def keys_upload(self, _request: web.Request) -> web.Response:
+        return web.json_response({"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def keys_query(self, _request: web.Request) -> web.Response:
+        return web.json_response({"device_keys": {}, "failures": {}})
+
+    async def keys_claim(self, _request: web.Request) -> web.Response:
+        return web.json_response({"one_time_keys": {}, "failures": {}})
+
+    async def empty(self, _request: web.Request) -> web.Response:
+        return web.json_response({})
+
+    # Synapse admin API
+
+    def room_details(self, room: FakeRoom) -> Dict:
+        create = room.get_state("m.room.create") or {}
+        return {
+            "room_id": room.room_id,
+            "name": (room.get_state("m.room.name") or {}).get("name"),
+            "canonical_alias": (room.get_state("m.room.canonical_alias") or {}).get("alias"),
+            "joined_members": len(room.members),
+            "joined_local_members": len([m for m in room.members if m.endswith(f":{self.server_name}")]),
+            "version": create.get("room_version"),
+            "creator": create.get("creator"),
+            "encryption": (room.get_state("m.room.encryption") or {}).get("algorithm"),
+            "federatable": create.get("m.federate", True),
+            "public": room.visibility == "public",
+            "join_rules": (room.get_state("m.room.join_rules") or {}).get("join_rule"),
+            "guest_access": None,
+            "history_visibility": None,
+            "state_events": len(room.state),
+            "room_type": create.get("type"),
+        }
+
+    async def admin_rooms(self, request: web.Request) -> web.Response:
+        start = int(request.query.get("from", 0))
+        limit = int(request.query.get("limit", 100))
+        rooms = list(self.rooms.values())
+        data = {
+            "rooms": [self.room_details(room) for room in rooms[start:start + limit]],
+            "offset": start,
+            "total_rooms": len(rooms),
+        }
+        if start + limit < len(rooms):
+            data["next_batch"] = start + limit
+        if start:
+            data["prev_batch"] = max(start - limit, 0)
+        return web.json_response(data)
+
+    async def admin_room(self, request: web.Request) -> web.Response:
+        return web.json_response(self.room_details(self.get_room(request)))
+
+    async def admin_user_login(self, request: web.Request) -> web.Response:
+        token = uuid.uuid4().hex
+        self.tokens[token] = request.match_info["user_id"]
+        return web.json_response({"access_token": token})
+
+    async def admin_joined_rooms(self, request: web.Request) -> web.Response:
+        user_id = request.match_info["user_id"]
+        rooms = [room.room_id for room in self.rooms.values() if user_id in room.members]
+        return web.json_response({"joined_rooms": rooms, "total": len(rooms)})
+
+    async def admin_join(self, request: web.Request) -> web.Response:
+        user_id = (await request.json()).get("user_id")
+        room = self.join_room(request.match_info["room_id_or_alias"], user_id)
+        if not room:
+            return error(404, "M_NOT_FOUND", "Unknown room")
+        await self.notify()
+        return web.json_response({"room_id": room.room_id})
+
+    async def admin_make_room_admin(self, request: web.Request) -> web.Response:
+        room = self.get_room(request)
+        user_id = (await request.json()).get("user_id")
+        if user_id not in room.members:
+            self.add_event(room, user_id, "m.room.member", {"membership": "join"}, user_id)
+        power_levels = deepcopy(room.get_state("m.room.power_levels") or DEFAULT_POWER_LEVELS)
+        power_levels.setdefault("users", {})[user_id] = 100
+        self.add_event(room, user_id, "m.room.power_levels", power_levels, "")
+        await self.notify()
+        return web.json_response({})
+
+    # Server
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware])
+        routes = []
+        for prefix in CLIENT_PREFIXES:
+            rooms = f"{prefix}/rooms/{{room_id}}"
+            user_tags = f"{prefix}/user/{{user_id}}/rooms/{{room_id}}/tags"
+            routes += [
+                web.post(f"{prefix}/login", self.login),
+                web.get(f"{prefix}/sync", self.sync),
+                web.post(f"{prefix}/createRoom", self.handle_create_room),
+                web.get(f"{rooms}/state", self.get_state),
+                web.get(f"{rooms}/state/{{event_type}}", self.get_state_event),
+                web.get(f"{rooms}/state/{{event_type}}/{{state_key}}", self.get_state_event),
+                web.put(f"{rooms}/state/{{event_type}}", self.put_state_event),
+                web.put(f"{rooms}/state/{{event_type}}/{{state_key}}", self.put_state_event),
+                web.put(f"{rooms}/send/{{event_type}}/{{txn_id}}", self.send),
+                web.post(f"{rooms}/invite", self.invite),
+                web.post(f"{rooms}/join", self.join_by_room_id),
+                web.post(f"{rooms}/leave", self.leave),
+                web.get(f"{rooms}/joined_members", self.joined_members),
+                web.post(f"{rooms}/receipt/{{receipt_type}}/{{event_id}}", self.empty),
+                web.post(f"{rooms}/read_markers", self.empty),
+                web.put(f"{rooms}/typing/{{user_id}}", self.empty),
+                web.post(f"{prefix}/join/{{room_id_or_alias}}", self.join),
+                web.get(f"{prefix}/directory/room/{{alias}}", self.resolve_alias),
+                web.put(f"{prefix}/directory/room/{{alias}}", self.put_alias),
+                web.delete(f"{prefix}/directory/room/{{alias}}", self.delete_alias),
+                web.get(f"{prefix}/directory/list/room/{{room_id}}", self.get_visibility),
+                web.put(f"{prefix}/directory/list/room/{{room_id}}", self.put_visibility),
+                web.get(f"{prefix}/profile/{{user_id}}", self.profile),
+                web.get(user_tags, self.get_tags),
+                web.put(f"{user_tags}/{{tag}}", self.put_tag),
+                web.delete(f"{user_tags}/{{tag}}", self.delete_tag),
+                web.post(f"{prefix}/keys/upload", self.keys_upload),
+                web.post(f"{prefix}/keys/query", self.keys_query),
+                web.post(f"{prefix}/keys/claim", self.keys_claim),
+                web.put(f"{prefix}/sendToDevice/{{event_type}}/{{txn_id}}", self.empty),
+            ]
+        routes += [
+            web.get("/_matrix/client/versions", self.versions),
+            web.get(f"{ADMIN_PREFIX}/rooms", self.admin_rooms),
+            web.get(f"{ADMIN_PREFIX}/rooms/{{room_id}}", self.admin_room),
+            web.post(f"{ADMIN_PREFIX}/rooms/{{room_id}}/make_room_admin", self.admin_make_room_admin),
+            web.post(f"{ADMIN_PREFIX}/users/{{user_id}}/login", self.admin_user_login),
+            web.get(f"{ADMIN_PREFIX}/users/{{user_id}}/joined_rooms", self.admin_joined_rooms),
+            web.post(f"{ADMIN_PREFIX}/join/{{room_id_or_alias}}", self.admin_join),
+        ]
+        app.add_routes(routes)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8008) -> web.AppRunner:
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info("Fake homeserver for %s listening on http://%s:%s", self.server_name, host, port)
+        return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Matrix homeserver for testing Bubo")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--server-name", default="example.com")
+    parser.add_argument("--user-id", help="The bot user, defaults to @bubo:<server name>")
+    parser.add_argument("--rooms", type=int, default=0, help="Number of rooms to seed")
+    parser.add_argument("--members", type=int, default=10, help="Members in each seeded room besides the bot")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every response except sync")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra latency up to this much")
+    parser.add_argument("--ratelimit", type=float, default=0, help="Share of requests answered with 429, 0-1")
+    parser.add_argument("--retry-after-ms", type=int, default=500, help="retry_after_ms in 429 responses")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible room populations")
+    parser.add_argument("--database", help="Also store the seeded rooms in this Bubo database")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.seed is not None:
+        random.seed(args.seed)
+    server = FakeHomeserver(
+        server_name=args.server_name,
+        user_id=args.user_id,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        ratelimit=args.ratelimit,
+        retry_after_ms=args.retry_after_ms,
+    )
+    server.seed_rooms(args.rooms, members=args.members)
+
+    loop = asyncio.get_event_loop()
+    if args.database:
+        loop.run_until_complete(server.seed_database(args.database))
+    runner = loop.run_until_complete(server.start(args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Served %s requests, %s rate limited", server.requests, server.throttled)
+        loop.run_until_complete(runner.cleanup())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+Microbenchmarks for bubo.storage.Storage.
+
+Fills a temporary database with synthetic rooms, breakout rooms and encrypted events,
+then times every public Storage method plus database setup and migrations. Results are
+printed as JSON, one entry per operation with ops/sec and latency percentiles.
+
+Every query the timed operations run is also checked with EXPLAIN QUERY PLAN. The benchmark
+fails if any of them scans a table instead of using an index, other than FULL_SCAN_QUERIES.
+
+Usage:
+
+    python -m benchmarks.storage --rooms 10000
+    python -m benchmarks.storage --rooms 200000 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List
+
+# noinspection PyPackageRequirements
+from nio import MegolmEvent
+
+from bubo.storage import Storage, latest_db_version
+
+SERVER_NAME = "example.com"
+
+# Queries that read a whole table on purpose, by the start of their normalized SQL
+FULL_SCAN_QUERIES = (
+    # Pruning to the newest events steps back from the end of the primary key
+    "delete from encrypted_events where id <= (select id from encrypted_events order by id desc limit",
+)
+
+
+def make_encrypted_event(index: int, session_id: str) -> MegolmEvent:
+    return MegolmEvent.from_dict({
+        "type": "m.room.encrypted",
+        "event_id": f"$encrypted{index}",
+        "sender": f"@user{index}:{SERVER_NAME}",
+        "origin_server_ts": 1600000000000 + index,
+        "room_id": f"!room{index}:{SERVER_NAME}",
+        "content": {
+            "algorithm": "m.megolm.v1.aes-sha2",
+            "ciphertext": "A" * 256,
+            "sender_key": "senderkey",
+            "device_id": "DEVICEID",
+            "session_id": session_id,
+        },
+    })
+
+
+def populate(store: Storage, rooms: int, breakout_rooms: int, encrypted_events: int, sessions: int):
+    """Fill the database directly, bypassing the API under test"""
+    now = int(time.time())
+    # One room in a hundred has been marked dirty by sync, the rest were maintained at different times
+    store.conn.executemany("""
+        insert into rooms (name, alias, room_id, title, encrypted, public, type, dirty, maintained_at)
+            values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (f"Room {i}", f"room{i}", f"!room{i}:{SERVER_NAME}", f"Title {i}", i % 2, i % 3 == 0,
+         "space" if i % 10 == 0 else "room", now * 1000 if i % 100 == 0 else 0, now - i % 86400)
+        for i in range(rooms)
+    ])
+    store.conn.executemany("""
+        insert into breakout_rooms (event_id, room_id) values (?, ?)
+    """, [(f"$breakout{i}", f"!breakout{i}:{SERVER_NAME}") for i in range(breakout_rooms)])
+    store.conn.executemany("""
+        insert into encrypted_events (device_id, event_id, room_id, session_id, event, timestamp)
+            values (?, ?, ?, ?, ?, ?)
+    """, [
+        ("DEVICEID", f"$stored{i}", f"!room{i % max(rooms, 1)}:{SERVER_NAME}", f"session{i % sessions}",
+         json.dumps(make_encrypted_event(i, f"session{i % sessions}").source), now)
+        for i in range(encrypted_events)
+    ])
+    store.conn.executemany("""
+        insert into room_state (room_id, type, content, timestamp) values (?, ?, ?, ?)
+    """, [
+        (f"!room{i}:{SERVER_NAME}", "m.room.power_levels", json.dumps({"users": {f"@admin:{SERVER_NAME}": 100}}), now)
+        for i in range(rooms)
+    ])
+    store.conn.commit()
+
+
+def summarize(latencies: List[float], ops_per_call: int = 1) -> Dict:
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    calls = len(latencies)
+    return {
+        "calls": calls,
+        "ops": calls * ops_per_call,
+        "ops_per_sec": round(calls * ops_per_call / total, 1) if total else None,
+        "mean_ms": round(statistics.mean(latencies) * 1000, 4),
+        "p50_ms": round(latencies[int(calls * 0.50)] * 1000, 4),
+        "p99_ms": round(latencies[min(int(calls * 0.99), calls - 1)] * 1000, 4),
+        "max_ms": round(latencies[-1] * 1000, 4),
+    }
+
+
+def normalize_query(sql: str) -> str:
+    """Replace the values in a traced query with placeholders, so that runs of the same query match"""
+    sql = re.sub(r"'(?:[^']|'')*'|\b\d+\b", "?", sql)
+    sql = re.sub(r"\( | \)", lambda match: match.group().strip(), " ".join(sql.split()))
+    sql = re.sub(r"\(\?(?:, ?\?)*\)", "(?)", sql)
+    return sql.rstrip(";").strip()
+
+
+def check_query_plans(conn: sqlite3.Connection, statements: List[str]) -> Dict[str, str]:
+    """
+    Run EXPLAIN QUERY PLAN on every distinct query Storage ran and require them to use an index.
+
+    Returns the plan of each query. Raises AssertionError listing any query that scans a
+    table, unless it is one of FULL_SCAN_QUERIES.
+    """
+    samples = {}
+    for sql in statements:
+        if sql.split(None, 1)[0].lower() in ("select", "update", "delete"):
+            samples.setdefault(normalize_query(sql), sql)
+    plans = {}
+    scans = []
+    for query, sql in sorted(samples.items()):
+        details = " / ".join(row[3] for row in conn.execute(f"explain query plan {sql}").fetchall())
+        plans[query] = details
+        if re.search(r"\bSCAN\b", details) and not query.startswith(FULL_SCAN_QUERIES):
+            scans.append(f"{query}\n    {details}")
+    if scans:
+        raise AssertionError("Queries not using an index:\n" + "\n".join(scans))
+    return plans
+
+
+async def measure(
+    iterations: int, func: Callable[[int], Awaitable], ops_per_call: int = 1,
+) -> Dict:
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await func(i)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, ops_per_call)
+
+
+def measure_setup(db_path: str, version: int = None) -> Dict:
+    """Time Storage construction, optionally on a database at an older schema version"""
+    if version is not None:
+        conn = sqlite3.connect(db_path)
+        conn.execute("create table database_version (version INTEGER)")
+        conn.execute("insert into database_version (version) values (?)", (version,))
+        conn.commit()
+        conn.close()
+    start = time.perf_counter()
+    Storage(db_path)
+    return summarize([time.perf_counter() - start])
+
+
+async def run(args, workdir: str) -> Dict:
+    results = {}
+
+    results["setup_fresh_database"] = measure_setup(os.path.join(workdir, "fresh.db"))
+    results["_run_migrations_from_0"] = measure_setup(os.path.join(workdir, "migrated.db"), version=0)
+
+    db_path = os.path.join(workdir, "bench.db")
+    store = Storage(db_path)
+    populate(store, args.rooms, args.breakout_rooms, args.encrypted_events, args.sessions)
+    store.conn.close()
+
+    results["setup_load_existing_database"] = measure_setup(db_path)
+    store = Storage(db_path)
+    # Record every statement the measured operations run, for checking their query plans
+    statements = []
+    store.conn.set_trace_callback(statements.append)
+
+    n = args.iterations
+    rooms = args.rooms
+
+    results["get_room"] = await measure(n, lambda i: store.get_room(f"!room{i * 7919 % rooms}:{SERVER_NAME}"))
+    results["get_room_by_alias"] = await measure(
+        n, lambda i: store.get_room_by_alias(f"#room{i * 7919 % rooms}:{SERVER_NAME}"),
+    )
+    results["get_room_id"] = await measure(n, lambda i: store.get_room_id(f"#room{i * 7919 % rooms}:{SERVER_NAME}"))
+    results["get_rooms"] = await measure(max(n // 100, 1), lambda i: store.get_rooms())
+    results["get_rooms_spaces"] = await measure(max(n // 100, 1), lambda i: store.get_rooms(spaces=True))
+    results["get_rooms_for_maintenance"] = await measure(
+        max(n // 100, 1), lambda i: store.get_rooms_for_maintenance(args.sample_size),
+    )
+    results["get_room_state"] = await measure(
+        n, lambda i: store.get_room_state(f"!room{i * 7919 % rooms}:{SERVER_NAME}", "m.room.power_levels"),
+    )
+    results["get_breakout_room_hit"] = await measure(
+        n, lambda i: store.get_breakout_room(f"$breakout{i % max(args.breakout_rooms, 1)}"),
+    )
+    results["get_breakout_room_miss"] = await measure(n, lambda i: store.get_breakout_room(f"$other{i}"))
+    results["get_encrypted_events"] = await measure(
+        n, lambda i: store.get_encrypted_events(f"session{i % args.sessions}"),
+    )
+
+    results["store_room"] = await measure(
+        n, lambda i: store.store_room(f"New {i}", f"new{i}", f"!new{i}:{SERVER_NAME}", "", 0, 0, "room"),
+    )
+    results["set_room_id"] = await measure(n, lambda i: store.set_room_id(f"new{i}", f"!renamed{i}:{SERVER_NAME}"))
+    results["set_room_alias"] = await measure(n, lambda i: store.set_room_alias(f"!renamed{i}:{SERVER_NAME}", f"moved{i}"))
+    results["unlink_room"] = await measure(n, lambda i: store.unlink_room(f"!renamed{i}:{SERVER_NAME}"))
+
+    batch_size = args.batch_size
+    results["store_rooms"] = await measure(
+        max(n // batch_size, 1),
+        lambda i: store.store_rooms([
+            (f"Bulk {i}-{j}", f"bulk{i}-{j}", None, "", 0, 0, "room") for j in range(batch_size)
+        ]),
+        ops_per_call=batch_size,
+    )
+    results["set_room_ids"] = await measure(
+        max(n // batch_size, 1),
+        lambda i: store.set_room_ids({f"bulk{i}-{j}": f"!bulk{i}-{j}:{SERVER_NAME}" for j in range(batch_size)}),
+        ops_per_call=batch_size,
+    )
+
+    async def batch_writes(i: int):
+        async with store.batch() as batch:
+            for j in range(batch_size):
+                await batch.store_room(f"Batch {i}-{j}", f"batch{i}-{j}", None, "", 0, 0, "room")
+    results["batch"] = await measure(max(n // batch_size, 1), batch_writes, ops_per_call=batch_size)
+
+    results["store_room_state"] = await measure(
+        n, lambda i: store.store_room_state(f"!room{i % rooms}:{SERVER_NAME}", "m.room.join_rules", {"join_rule": "invite"}),
+    )
+    results["store_room_states"] = await measure(
+        max(n // batch_size, 1),
+        lambda i: store.store_room_states([
+            (f"!room{(i * batch_size + j) % rooms}:{SERVER_NAME}", "m.room.create", {"creator": "@a:b"})
+            for j in range(batch_size)
+        ]),
+        ops_per_call=batch_size,
+    )
+
+    results["mark_rooms_dirty"] = await measure(
+        max(n // batch_size, 1),
+        lambda i: store.mark_rooms_dirty([
+            f"!room{(i * batch_size + j) % rooms}:{SERVER_NAME}" for j in range(batch_size)
+        ]),
+        ops_per_call=batch_size,
+    )
+    results["set_rooms_maintained"] = await measure(
+        max(n // batch_size, 1),
+        lambda i: store.set_rooms_maintained(
+            [f"!room{(i * batch_size + j) % rooms}:{SERVER_NAME}" for j in range(batch_size)],
+            int(time.time() * 1000),
+        ),
+        ops_per_call=batch_size,
+    )
+
+    results["store_breakout_room"] = await measure(
+        n, lambda i: store.store_breakout_room(f"$newbreakout{i}", f"!newbreakout{i}:{SERVER_NAME}"),
+    )
+
+    events = [make_encrypted_event(args.encrypted_events + i, f"newsession{i % 10}") for i in range(n)]
+    results["store_encrypted_event"] = await measure(n, lambda i: store.store_encrypted_event(events[i]))
+    results["remove_encrypted_event"] = await measure(n, lambda i: store.remove_encrypted_event(events[i].event_id))
+    results["prune_encrypted_events"] = await measure(
+        10, lambda i: store.prune_encrypted_events(args.ttl, args.encrypted_events - i * 100),
+    )
+
+    results["store_recreate_room"] = await measure(n, lambda i: store.store_recreate_room("@admin:b", f"!recreate{i}"))
+    results["get_recreate_room"] = await measure(n, lambda i: store.get_recreate_room(f"!recreate{i}"))
+    results["set_recreate_room_applied"] = await measure(n, lambda i: store.set_recreate_room_applied(f"!recreate{i}"))
+    results["delete_recreate_room"] = await measure(n, lambda i: store.delete_recreate_room(f"!recreate{i}"))
+
+    store.conn.set_trace_callback(None)
+    query_plans = check_query_plans(store.conn, statements)
+
+    return {
+        "parameters": {
+            "rooms": args.rooms,
+            "breakout_rooms": args.breakout_rooms,
+            "encrypted_events": args.encrypted_events,
+            "sessions": args.sessions,
+            "iterations": args.iterations,
+            "batch_size": args.batch_size,
+            "sample_size": args.sample_size,
+            "db_version": latest_db_version,
+            "sqlite_version": sqlite3.sqlite_version,
+            "python_version": sys.version.split()[0],
+        },
+        "results": results,
+        "query_plans": query_plans,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bubo.storage.Storage")
+    parser.add_argument("--rooms", type=int, default=10000)
+    parser.add_argument("--breakout-rooms", type=int, default=None, help="Defaults to the number of rooms")
+    parser.add_argument("--encrypted-events", type=int, default=None, help="Defaults to the number of rooms")
+    parser.add_argument("--sessions", type=int, default=1000, help="Number of Megolm sessions to spread events over")
+    parser.add_argument("--iterations", type=int, default=1000, help="Calls per measured operation")
+    parser.add_argument("--batch-size", type=int, default=100, help="Rooms per call for bulk operations")
+    parser.add_argument(
+        "--sample-size", type=int, default=50, help="Clean rooms sampled when getting rooms for maintenance",
+    )
+    parser.add_argument("--ttl", type=int, default=3600, help="TTL in seconds used for pruning")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    if args.breakout_rooms is None:
+        args.breakout_rooms = args.rooms
+    if args.encrypted_events is None:
+        args.encrypted_events = args.rooms
+
+    with tempfile.TemporaryDirectory(prefix="bubo-bench-") as workdir:
+        report = asyncio.run(run(args, workdir))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
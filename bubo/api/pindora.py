@@ -1,8 +1,9 @@
-import requests
 import json
 from datetime import datetime, timedelta
 from pytz import timezone
 
+from bubo.metrics import timed_request
+
 
 def get_headers(pindora_token):
     headers = {
@@ -33,8 +34,8 @@ def create_new_key(pindora_id, pindora_token, name, pindora_timezone=None, hours
         "magic_enabled": True,
     })
 
-    response = requests.request(
-        "POST", url, headers=get_headers(pindora_token), data=payload)
+    response = timed_request(
+        "pindora", "POST", url, headers=get_headers(pindora_token), data=payload)
     response.raise_for_status()
     response_json = response.json()
 
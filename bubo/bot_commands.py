@@ -1,3 +1,4 @@
+import asyncio
 import csv
 import logging
 import re
@@ -16,18 +17,26 @@ from nio.schemas import check_user_id
 from bubo import help_strings
 from bubo.chat_functions import send_text_to_room, invite_to_room
 from bubo.discourse import Discourse
+from bubo.maintenance import scheduler
 from bubo.rooms import (
     ensure_room_exists, create_breakout_room, set_user_power, get_room_power_levels, recreate_room,
     add_alias, remove_alias, set_canonical_alias,
 )
-from bubo.synapse_admin import make_room_admin, join_users, get_user_rooms
+from bubo.storage import Room
+from bubo.synapse_admin import make_room_admin, join_users, get_user_joined_room_ids, get_rooms
 from bubo.users import list_users, get_user_by_attr, create_user, send_password_reset, invite_user, create_signup_link
-from bubo.utils import get_users_for_access, with_ratelimit, ensure_room_id
+from bubo.utils import get_users_for_access, ensure_room_id, get_joined_members, get_synced_room
 from bubo.api.pindora import create_new_key
 
 
 logger = logging.getLogger(__name__)
 
+# Room lists longer than this are sent to the command room in parts
+USER_ROOMS_PAGE_SIZE = 50
+
+# Fallback invites in flight at a time when joining users, further paced by the membership rate limit
+JOIN_INVITE_CONCURRENCY = 10
+
 TEXT_PERMISSION_DENIED = "I'm afraid I cannot let you do that."
 
 
@@ -105,6 +114,8 @@ class Command(object):
             await self._invite()
         elif self.command.startswith("join"):
             await self._join()
+        elif self.command.startswith("maintenance"):
+            await self._maintenance()
         elif self.command.startswith("power"):
             await self._power()
         elif self.command.startswith("rooms"):
@@ -199,7 +210,7 @@ class Command(object):
             text += "\n\nReact to this message with any emoji reaction to get invited to the room."
             event_id = await send_text_to_room(self.client, self.room.room_id, text)
             if event_id:
-                self.store.store_breakout_room(event_id, room_id)
+                await self.store.store_breakout_room(event_id, room_id)
             else:
                 text = "*Error: failed to store breakout room data. The room was created, " \
                        "but invites via reactions will not work.*"
@@ -336,27 +347,51 @@ class Command(object):
         await self._join_users_to_room(room_id_or_alias, users)
 
     async def _join_users_to_room(self, room_id_or_alias: str, users: List[str]) -> None:
-        joined = 0
-        invited = 0
+        users = list(dict.fromkeys(users))
+        joined = []
+        invited = []
+        failed = {}
+        results = {}
 
         if self.config.is_synapse_admin:
-            joined = await join_users(self.config, users, room_id_or_alias)
+            results = await join_users(self.config, users, room_id_or_alias)
+            joined = [user for user in users if results.get(user, "") is None]
 
         room_id = await ensure_room_id(client=self.client, room_id_or_alias=room_id_or_alias)
 
-        if not self.config.is_synapse_admin or joined != len(users):
-            # Fallback invites
-            for user in users:
+        # Fallback invites for anyone who could not be joined
+        semaphore = asyncio.Semaphore(JOIN_INVITE_CONCURRENCY)
+
+        async def invite(user: str):
+            async with semaphore:
                 response = await self.client.room_invite(room_id, user)
-                if isinstance(response, RoomInviteError):
-                    logger.warning(f"Failed to invite user {user} to room {room_id}: "
-                                   f"{response.message} / {response.status_code}")
-                else:
-                    invited += 1
-        await send_text_to_room(
-            self.client, self.room.room_id,
-            f"Joined {joined} users and invited {invited} users to room {room_id}",
-        )
+            if isinstance(response, RoomInviteError):
+                logger.warning(f"Failed to invite user {user} to room {room_id}: "
+                               f"{response.message} / {response.status_code}")
+                failed[user] = f"{response.message} ({response.status_code})"
+                if results.get(user):
+                    failed[user] = f"join: {results[user]}; invite: {failed[user]}"
+            else:
+                invited.append(user)
+
+        await asyncio.gather(*(invite(user) for user in users if user not in joined))
+
+        message = f"Joined {len(joined)} users and invited {len(invited)} users to room {room_id}"
+        if failed:
+            failures = "<br>".join(f"{user}: {failed[user]}" for user in users if user in failed)
+            message += f"\n\nFailed to join or invite {len(failed)} users:\n\n{failures}"
+        await send_text_to_room(self.client, self.room.room_id, message)
+
+    async def _maintenance(self):
+        """Show how the last room maintenance went"""
+        if not await self._ensure_admin():
+            return
+
+        if self.args and self.args[0] == "help":
+            text = help_strings.HELP_MAINTENANCE
+        else:
+            text = scheduler.status()
+        await send_text_to_room(self.client, self.room.room_id, text)
 
     async def _power(self):
         """Set power in a room.
@@ -442,8 +477,14 @@ class Command(object):
                            f"Usage:\n\n{help_strings.HELP_SPACES if space else help_strings.HELP_ROOMS}"
                 else:
                     result, room_id = await ensure_room_exists(
-                        (None, params[0], params[1], None, params[2], None, True if params[3] == "yes" else False,
-                         True if params[4] == "yes" else False, "space" if space else "room"),
+                        Room(
+                            name=params[0],
+                            alias=params[1],
+                            title=params[2],
+                            encrypted=params[3] == "yes",
+                            public=params[4] == "yes",
+                            type="space" if space else "room",
+                        ),
                         self.client,
                         self.store,
                         self.config,
@@ -514,7 +555,7 @@ class Command(object):
                 self.client, self.room.room_id, f"Error resolving room ID",
             )
 
-        room = self.store.get_room(room_id)
+        room = await self.store.get_room(room_id)
         if room:
             return await send_text_to_room(
                 self.client, self.room.room_id, f"Room {room_id} is already tracked by Bubo.",
@@ -546,7 +587,7 @@ class Command(object):
         else:
             if make_admin and self.config.is_synapse_admin:
                 # Are we admin?
-                _state, users = await get_room_power_levels(self.client, room_id)
+                _state, users = await get_room_power_levels(self.client, self.store, self.config, room_id)
                 if users and users.get(self.config.user_id, 0) < 100:
                     response = await make_room_admin(config=self.config, room_id=room_id, user_id=self.config.user_id)
                     if not response:
@@ -556,33 +597,20 @@ class Command(object):
                         )
 
         # Get some data
-        # We can't trust the room is in the matrix-nio store at this stage yet
-        name = ""
-        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.name")
-        if isinstance(response, RoomGetStateEventResponse):
-            name = response.content.get("name")
-        alias = ""
-        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.canonical_alias")
-        if isinstance(response, RoomGetStateEventResponse):
-            alias = response.content.get("alias")
-            if alias:
-                alias = alias.lstrip("#").split(":")[0]
-        title = ""
-        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.topic")
-        if isinstance(response, RoomGetStateEventResponse):
-            title = response.content.get("title")
-        encrypted = False
-        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.encryption")
-        if isinstance(response, RoomGetStateEventResponse):
-            encrypted = True
-        public = False
-        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.join_rules")
-        if isinstance(response, RoomGetStateEventResponse):
-            public = response.content.get("join_rule") == "public"
-        room_type = "room"
-        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.create")
-        if isinstance(response, RoomGetStateEventResponse):
-            room_type = "space" if response.content.get("type") == "m.space" else "room"
+        # If Bubo was already in the room, the matrix-nio store has it. Otherwise we can't
+        # trust the room is in the store at this stage yet, so fetch the state instead.
+        # Fetched state is kept as the initial snapshot for the room once linked
+        states = []
+        synced_room = get_synced_room(self.client, room_id)
+        if synced_room:
+            name = synced_room.name or ""
+            alias = (synced_room.canonical_alias or "").lstrip("#").split(":")[0]
+            title = synced_room.topic or ""
+            encrypted = synced_room.encrypted
+            public = synced_room.join_rule == "public"
+            room_type = "space" if synced_room.room_type == "m.space" else "room"
+        else:
+            name, alias, title, encrypted, public, room_type = await self._fetch_room_details(room_id, states)
 
         if not name or not alias:
             # Currently required :(
@@ -598,7 +626,7 @@ class Command(object):
                 )
             return
 
-        self.store.store_room(
+        await self.store.store_room(
             name=name,
             alias=alias,
             room_id=room_id,
@@ -607,38 +635,77 @@ class Command(object):
             public=public,
             room_type=room_type,
         )
+        await self.store.store_room_states(states)
 
         return await send_text_to_room(
             self.client, self.room.room_id, f"Room {room_id} has been added to the Bubo database.",
         )
 
+    async def _fetch_room_details(self, room_id: str, states: List) -> Tuple[str, str, str, bool, bool, str]:
+        """
+        Fetch the details needed to link a room from the homeserver.
+
+        Snapshot worthy state is appended to `states`. Returns the name, alias localpart,
+        title, whether the room is encrypted, whether it is public and its type.
+        """
+        name = ""
+        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.name")
+        if isinstance(response, RoomGetStateEventResponse):
+            name = response.content.get("name")
+        alias = ""
+        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.canonical_alias")
+        if isinstance(response, RoomGetStateEventResponse):
+            states.append((room_id, "m.room.canonical_alias", response.content))
+            alias = response.content.get("alias")
+            if alias:
+                alias = alias.lstrip("#").split(":")[0]
+        title = ""
+        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.topic")
+        if isinstance(response, RoomGetStateEventResponse):
+            title = response.content.get("title")
+        encrypted = False
+        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.encryption")
+        if isinstance(response, RoomGetStateEventResponse):
+            states.append((room_id, "m.room.encryption", response.content))
+            encrypted = True
+        public = False
+        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.join_rules")
+        if isinstance(response, RoomGetStateEventResponse):
+            states.append((room_id, "m.room.join_rules", response.content))
+            public = response.content.get("join_rule") == "public"
+        room_type = "room"
+        response = await self.client.room_get_state_event(room_id=room_id, event_type="m.room.create")
+        if isinstance(response, RoomGetStateEventResponse):
+            states.append((room_id, "m.room.create", response.content))
+            room_type = "space" if response.content.get("type") == "m.space" else "room"
+
+        return name, alias, title, encrypted, public, room_type
+
     async def _list_no_admin_rooms(self, spaces: bool = False):
         text = f"I lack admin power in the following {'spaces' if spaces else 'rooms'} I maintain:\n\n"
-        rooms = self.store.get_rooms(spaces=spaces)
+        rooms = await self.store.get_rooms(spaces=spaces)
         rooms_list = []
         for room in rooms:
-            _state, users = await get_room_power_levels(self.client, room["room_id"])
+            _state, users = await get_room_power_levels(self.client, self.store, self.config, room.room_id)
             if users and users.get(self.config.user_id, 0) < 100:
-                joined_members = await with_ratelimit(
-                    self.client, "joined_members", room_id=room["room_id"],
-                )
+                joined_members = await get_joined_members(self.client, room.room_id)
                 user_count = getattr(joined_members, "members", None)
                 suffix = ""
                 admin_users = [user for user, power in users.items() if power == 100]
                 if len(admin_users):
                     suffix = f". **The {'space' if spaces else 'room'} has {len(admin_users)} other admins.**"
-                rooms_list.append(f"* {room['name']} / #{room['alias']}:{self.config.server_name} / "
-                                  f"{room['room_id']} / users: {len(user_count) if user_count else 'unknown'}"
+                rooms_list.append(f"* {room.name} / #{room.alias}:{self.config.server_name} / "
+                                  f"{room.room_id} / users: {len(user_count) if user_count else 'unknown'}"
                                   f"{suffix}\n")
         text += "".join(rooms_list)
         return text
 
     async def _list_rooms(self, spaces: bool = False):
         text = f"I currently maintain the following {'spaces' if spaces else 'rooms'}:\n\n"
-        rooms = self.store.get_rooms(spaces=spaces)
+        rooms = await self.store.get_rooms(spaces=spaces)
         rooms_list = []
         for room in rooms:
-            rooms_list.append(f"* {room['name']} / #{room['alias']}:{self.config.server_name} / {room['room_id']}\n")
+            rooms_list.append(f"* {room.name} / #{room.alias}:{self.config.server_name} / {room.room_id}\n")
         text += "".join(rooms_list)
         return text
 
@@ -690,15 +757,15 @@ class Command(object):
             return
 
         if not subcommand:
-            room = self.store.get_recreate_room(self.room.room_id)
+            room = await self.store.get_recreate_room(self.room.room_id)
             if room:
-                if room["applied"] == 1:
+                if room.applied == 1:
                     return await send_text_to_room(
                         self.client, self.room.room_id,
                         "Can only recreate a room once, this room has already been recreated.",
                     )
-                self.store.delete_recreate_room(self.room.room_id)
-            self.store.store_recreate_room(self.event.sender, self.room.room_id)
+                await self.store.delete_recreate_room(self.room.room_id)
+            await self.store.store_recreate_room(self.event.sender, self.room.room_id)
             return await send_text_to_room(
                 self.client, self.room.room_id, help_strings.HELP_ROOMS_RECREATE_CONFIRM % self.config.command_prefix,
             )
@@ -708,18 +775,18 @@ class Command(object):
                 self.client, self.room.room_id, f"Unknown subcommand. Usage:\n\n{help_strings.HELP_ROOMS_RECREATE}",
             )
 
-        room = self.store.get_recreate_room(self.room.room_id)
+        room = await self.store.get_recreate_room(self.room.room_id)
         if not room:
             return await send_text_to_room(
                 self.client, self.room.room_id,
                 "Cannot confirm room recreate before requesting room recreate.",
             )
-        if room["requester"] != self.event.sender:
+        if room.requester != self.event.sender:
             return await send_text_to_room(
                 self.client, self.room.room_id,
                 "Room recreate confirm must be given by the room recreate requester.",
             )
-        if int(time.time()) - room["timestamp"] > 300:
+        if int(time.time()) - room.timestamp > 300:
             return await send_text_to_room(
                 self.client, self.room.room_id,
                 "Room recreate confirmation must be given within 300 seconds. Please request recreation again.",
@@ -762,13 +829,13 @@ class Command(object):
                 self.client, self.room.room_id, f"Error resolving room ID",
             )
 
-        room = self.store.get_room(room_id)
+        room = await self.store.get_room(room_id)
         if not room:
             return await send_text_to_room(
                 self.client, self.room.room_id, f"Cannot unlink room {room_id} which doesn't seem tracked by Bubo",
             )
 
-        self.store.unlink_room(room_id)
+        await self.store.unlink_room(room_id)
 
         if leave:
             await self.client.room_leave(room_id)
@@ -899,23 +966,39 @@ class Command(object):
                         self.room.room_id,
                         f"Invalid user mxid: {user_id}",
                     )
-                rooms = await get_user_rooms(self.config, user_id)
-                if not rooms:
+                room_ids = await get_user_joined_room_ids(self.config, user_id)
+                if not room_ids:
                     return await send_text_to_room(
                         self.client, self.room.room_id,
                         f"Cannot find {user_id} in any rooms on this server.",
                     )
-                else:
+
+                def format_rooms(rooms: List[Dict]) -> str:
                     room_list = []
                     for room in rooms:
                         room_str = f"{room.get('name')} ({room.get('canonical_alias')})" \
                             if room.get("canonical_alias") else \
                             f"{room.get('name')} ({room.get('room_id')})"
                         room_list.append(room_str)
+                    return '<br>'.join(room_list)
+
+                if len(room_ids) <= USER_ROOMS_PAGE_SIZE:
+                    rooms = []
+                    async for batch in get_rooms(self.config, room_ids):
+                        rooms.extend(batch)
                     return await send_text_to_room(
                         self.client, self.room.room_id,
-                        f"User {user_id} found in the following rooms:\n\n{'<br>'.join(room_list)}"
+                        f"User {user_id} found in the following rooms:\n\n{format_rooms(rooms)}"
                     )
+
+                # Long lists are sent in parts as they are fetched
+                await send_text_to_room(
+                    self.client, self.room.room_id,
+                    f"User {user_id} found in {len(room_ids)} rooms, listing them in parts:",
+                )
+                async for batch in get_rooms(self.config, room_ids, batch_size=USER_ROOMS_PAGE_SIZE):
+                    await send_text_to_room(self.client, self.room.room_id, format_rooms(batch))
+                return
             elif self.args[0] == "signuplink":
                 if not await self._ensure_coordinator():
                     return
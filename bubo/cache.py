@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Set, Tuple
+
+from bubo.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+# Handed to waiters of a load whose caller was cancelled, telling them to load it themselves
+_RELOAD = object()
+
+
+class AsyncCache:
+    """
+    Size bounded cache for results of homeserver requests.
+
+    Entries expire after `ttl` seconds, unless given their own TTL, and the least recently
+    used entries are evicted once there are more than `max_size`. Concurrent lookups of the
+    same missing key share a single call to the loader. If the caller running the loader is
+    cancelled, the other callers retry the lookup.
+    """
+    def __init__(self, name: str, ttl: float = 60, max_size: int = 1000):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(
+        self, key: Hashable, loader: Callable[[], Awaitable], cache_if: Callable[[Any], bool] = None,
+        ttl: float = None,
+    ) -> Any:
+        """
+        Get a value, calling `loader` if it is not cached.
+
+        Results are cached if `cache_if` returns true for them, by default if they are not None.
+        They are cached for `ttl` seconds if given, otherwise for the TTL of the cache.
+        """
+        while True:
+            entry = self._entries.get(key)
+            if entry:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if key not in self._pending:
+                break
+            self.hits += 1
+            value = await asyncio.shield(self._pending[key])
+            if value is not _RELOAD:
+                return value
+            # The caller loading the value was cancelled, so try loading it here
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await loader()
+        except Exception as ex:
+            future.set_exception(ex)
+            # Don't warn about the exception not being retrieved if nobody else was waiting
+            future.exception()
+            raise
+        except BaseException:
+            # Cancellation of this caller is not an error of the other waiters
+            future.set_result(_RELOAD)
+            raise
+        else:
+            future.set_result(value)
+            if cache_if(value) if cache_if else value is not None:
+                self.set(key, value, ttl=ttl)
+            return value
+        finally:
+            del self._pending[key]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0 or not self.max_size:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Synapse admin room details by room ID
+room_details = AsyncCache("room_details")
+# Joined members responses by room ID
+joined_members = AsyncCache("joined_members")
+# Room state event content by room ID and event type
+room_state = AsyncCache("room_state")
+# Temporary user access tokens by user ID, each cached until shortly before it expires
+temporary_tokens = AsyncCache("temporary_tokens")
+
+caches = (room_details, joined_members, room_state, temporary_tokens)
+
+# Raw power levels content of rooms Bubo is joined to as delivered by sync, by room ID
+synced_power_levels: Dict[str, Dict] = {}
+
+# Room state Bubo has changed itself that sync has not yet delivered, by room ID and event
+# type. Until it has, matrix-nio's rooms don't reflect the change.
+unsynced_state: Set[Tuple[str, str]] = set()
+
+
+def state_changed(room_id: str, event_type: str):
+    """Forget cached state after Bubo has changed it"""
+    room_details.invalidate(room_id)
+    room_state.invalidate((room_id, event_type))
+    unsynced_state.add((room_id, event_type))
+
+
+def state_synced(room_id: str, event_type: str):
+    """Forget cached state after sync has delivered a change to it"""
+    room_details.invalidate(room_id)
+    room_state.invalidate((room_id, event_type))
+    unsynced_state.discard((room_id, event_type))
+
+
+def configure(config: Config):
+    for cache in caches:
+        cache.ttl = config.cache_ttl
+        cache.max_size = config.cache_max_entries
@@ -1,16 +1,25 @@
 import json
-from typing import Union
+from typing import List, Set, Union
 
 # noinspection PyPackageRequirements
-from nio import JoinError, MatrixRoom, MegolmEvent, RoomKeyEvent, Event, RoomMessageText, UnknownEvent
+from nio import JoinError, MatrixRoom, MegolmEvent, RoomKeyEvent, Event, RoomMessageText, UnknownEvent, SyncResponse
 
+from bubo import cache
 from bubo.bot_commands import Command
 from bubo.chat_functions import send_text_to_room, invite_to_room
 from bubo.message_responses import Message
+from bubo.storage import ROOM_STATE_TYPES
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Room state changes after which tracked rooms need maintenance
+DIRTYING_STATE_TYPES = (
+    "m.room.canonical_alias",
+    "m.room.power_levels",
+    "m.room.tombstone",
+)
+
 
 class Callbacks(object):
 
@@ -27,6 +36,8 @@ class Callbacks(object):
         self.store = store
         self.config = config
         self.command_prefix = config.command_prefix
+        # Next batch token of the last handled sync, which the following sync continues from
+        self.next_batch = None
 
     async def decrypted_callback(self, room_id: str, event: Union[RoomMessageText, UnknownEvent]):
         if isinstance(event, RoomMessageText):
@@ -90,29 +101,27 @@ class Callbacks(object):
             return
         # TODO split to "reactions.py" or similar
         # Breakout creation reaction?
-        room_id = self.store.get_breakout_room_id(event_id)
-        logger.debug(f"Breakout room query found room_id: {room_id}")
-        if room_id:
+        breakout_room = await self.store.get_breakout_room(event_id)
+        logger.debug(f"Breakout room query found: {breakout_room}")
+        if breakout_room:
             logger.info(f"Found breakout room for reaction in {room.room_id} by {event.sender} - "
-                        f"inviting to {room_id}")
+                        f"inviting to {breakout_room.room_id}")
             # Do an invitation
             await invite_to_room(
-                self.client, room_id, event.sender,
+                self.client, breakout_room.room_id, event.sender,
             )
 
     async def room_key(self, event: RoomKeyEvent):
         """Callback for ToDevice events like room key events."""
-        events = self.store.get_encrypted_events(event.session_id)
+        events = await self.store.get_encrypted_events(event.session_id)
         logger.debug("Got room key event for session %s, matched sessions: %s" % (event.session_id, len(events)))
         if not events:
             return
 
         for encrypted_event in events:
             try:
-                event_dict = json.loads(encrypted_event["event"])
-                params = event_dict["source"]
-                params["room_id"] = event_dict["room_id"]
-                params["transaction_id"] = event_dict["transaction_id"]
+                params = json.loads(encrypted_event["event"])
+                params["room_id"] = encrypted_event["room_id"]
                 megolm_event = MegolmEvent.from_dict(params)
             except Exception as ex:
                 logger.warning("Failed to restore MegolmEvent for %s: %s" % (encrypted_event["event_id"], ex))
@@ -127,7 +136,7 @@ class Callbacks(object):
                 logger.info(f"Successfully decrypted stored event %s" % decrypted.event_id)
                 parsed_event = Event.parse_event(decrypted.source)
                 logger.info(f"Parsed event: %s" % parsed_event)
-                self.store.remove_encrypted_event(decrypted.event_id)
+                await self.store.remove_encrypted_event(decrypted.event_id)
                 # noinspection PyTypeChecker
                 await self.decrypted_callback(encrypted_event["room_id"], parsed_event)
             else:
@@ -153,6 +162,95 @@ class Callbacks(object):
         # Successfully joined room
         logger.info(f"Joined {room.room_id}")
 
+    async def sync(self, response: SyncResponse):
+        """
+        Callback for sync responses.
+
+        Keeps the state snapshots of tracked rooms up to date and drops cached state and
+        members of rooms that changed. Tracked rooms with changes that room maintenance
+        may need to correct are marked dirty, except on an initial sync.
+        """
+        # Raising from a response callback would stop syncing
+        try:
+            await self._handle_sync_rooms(response)
+        except Exception:
+            logger.exception("Failed to handle rooms of sync response")
+
+    async def _handle_sync_rooms(self, response: SyncResponse):
+        # Without a token to continue from, the timeline is history rather than changes
+        initial = not (self.next_batch or self.client.loaded_sync_token)
+        self.next_batch = response.next_batch
+        states = {}
+        dirty = set()
+        coordinators = None
+        access_room_ids = self._access_room_ids()
+        for room_id, room_info in response.rooms.join.items():
+            tracked = await self.store.get_room(room_id)
+            # A gap in the timeline may hide changes
+            if tracked and room_info.timeline.limited:
+                dirty.add(room_id)
+            # Timeline events come after the state block, so the latest event wins
+            for i, event in enumerate(room_info.state + room_info.timeline.events):
+                source = getattr(event, "source", None) or {}
+                if source.get("state_key") is None:
+                    continue
+                # The state block holds all state on a full state sync, only new events are changes
+                changed = i >= len(room_info.state)
+                if source.get("type") == "m.room.member":
+                    cache.joined_members.invalidate(room_id)
+                    if not changed:
+                        continue
+                    if room_id in access_room_ids:
+                        dirty.update(await self._tracked_rooms_of(source["state_key"]))
+                    elif tracked:
+                        if coordinators is None:
+                            coordinators = self._coordinators()
+                        if source["state_key"] in coordinators:
+                            dirty.add(room_id)
+                elif source["state_key"] == "":
+                    cache.state_synced(room_id, source.get("type"))
+                    if tracked and source.get("type") in ROOM_STATE_TYPES:
+                        states[(room_id, source["type"])] = source.get("content", {})
+                    # Changes made by Bubo itself are already as maintenance wants them
+                    if tracked and changed and source.get("type") in DIRTYING_STATE_TYPES \
+                            and source.get("sender") != self.config.user_id:
+                        dirty.add(room_id)
+        if states:
+            logger.debug(f"Storing {len(states)} room state snapshots from sync")
+            await self.store.store_room_states(
+                [(room_id, event_type, content) for (room_id, event_type), content in states.items()],
+            )
+        if dirty and not initial:
+            logger.debug(f"Marking {len(dirty)} rooms as needing maintenance")
+            await self.store.mark_rooms_dirty(list(dirty))
+
+    def _access_room_ids(self) -> Set[str]:
+        """Rooms whose members are admins or coordinators"""
+        return {entry for entry in self.config.admins + self.config.coordinators if entry.startswith("!")}
+
+    def _coordinators(self) -> Set[str]:
+        """
+        Admins and coordinators, with members of access rooms as known from sync.
+        """
+        users = set()
+        for entry in self.config.admins + self.config.coordinators:
+            if entry.startswith("!"):
+                room = self.client.rooms.get(entry)
+                if room:
+                    users.update(room.users)
+            else:
+                users.add(entry)
+        return users
+
+    async def _tracked_rooms_of(self, user_id: str) -> List[str]:
+        """
+        Tracked rooms the user is in, as known from sync.
+        """
+        return [
+            room_id for room_id, room in self.client.rooms.items()
+            if user_id in room.users and await self.store.get_room(room_id)
+        ]
+
     async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent):
         """Callback for when an event fails to decrypt."""
         logger.warning(
@@ -169,4 +267,4 @@ class Callbacks(object):
                 self.client, room.room_id, user_msg, reply_to_event_id=event.event_id,
             )
 
-        self.store.store_encrypted_event(event)
+        await self.store.store_encrypted_event(event)
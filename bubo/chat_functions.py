@@ -1,10 +1,7 @@
-import asyncio
 import logging
-import time
 import uuid
 from typing import Optional
 
-import aiohttp
 # noinspection PyPackageRequirements
 from nio import (
     SendRetryError, RoomInviteError, AsyncClient, ErrorResponse, RoomSendResponse, ProfileGetResponse,
@@ -12,6 +9,7 @@ from nio import (
 from markdown import markdown
 
 from bubo.config import Config
+from bubo.http import request
 from bubo.utils import get_request_headers
 
 logger = logging.getLogger(__name__)
@@ -36,10 +34,6 @@ async def invite_to_room(
         return
     response = await client.room_invite(room_id, user_id)
     if isinstance(response, RoomInviteError):
-        if response.status_code == "M_LIMIT_EXCEEDED":
-            time.sleep(3)
-            await invite_to_room(client, room_id, user_id, command_room_id, room_alias)
-            return
         if command_room_id:
             if ignore_in_room and response.message.find("is already in the room") > -1:
                 await send_text_to_room(
@@ -113,11 +107,7 @@ async def send_text_to_room(
             ignore_unverified_devices=True,
         )
         if isinstance(response, ErrorResponse):
-            if response.status_code == "M_LIMIT_EXCEEDED":
-                time.sleep(3)
-                return await send_text_to_room(client, room_id, message, notice, markdown_convert)
-            else:
-                logger.warning(f"Failed to send message to {room_id} due to {response.status_code}")
+            logger.warning(f"Failed to send message to {room_id} due to {response.status_code}")
         elif isinstance(response, RoomSendResponse):
             return response.event_id
         else:
@@ -153,18 +143,14 @@ async def send_text_to_room_c2s(
         content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.put(
-                f"{config.homeserver_url}/_matrix/client/r0/rooms/{room_id}/send/m.room.message/{str(uuid.uuid4())}",
-                json=content,
-                headers=get_request_headers(config),
-            ) as response:
-                if response.status == 429:
-                    await asyncio.sleep(3)
-                    return await send_text_to_room_c2s(
-                        config, room_id, message, notice, markdown_convert, reply_to_event_id,
-                    )
-                response.raise_for_status()
-                return (await response.json())["event_id"]
+        response = await request(
+            "PUT",
+            f"{config.homeserver_url}/_matrix/client/r0/rooms/{room_id}/send/m.room.message/{str(uuid.uuid4())}",
+            "messages",
+            json=content,
+            headers=get_request_headers(config),
+        )
+        response.raise_for_status()
+        return (await response.json())["event_id"]
     except Exception as ex:
         logger.exception(f"Unable to send C2S message to {room_id}: {ex}")
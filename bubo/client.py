@@ -0,0 +1,78 @@
+import time
+from copy import deepcopy
+from typing import Any, Dict, Optional
+
+# noinspection PyPackageRequirements
+from aiohttp import ClientResponse
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+
+from bubo import cache
+from bubo.http import get_retry_after_ms
+from bubo.metrics import metrics, endpoint_label, body_size
+from bubo.ratelimit import endpoint_for_path, limiter
+
+
+class Client(AsyncClient):
+    """
+    matrix-nio client that rate limits and records metrics for every request to the homeserver.
+
+    Every request matrix-nio makes, syncing included, goes through `send`, so no client method
+    can bypass the shared rate limiter. Requests are limited and labelled by the rate limiting
+    class of their path, see `bubo.ratelimit`. Throttled requests are retried after waiting as
+    long as the server asks, up to `ratelimit.max_retries` times, after which the 429 response
+    is returned. The client should be configured to not retry throttled requests by itself.
+
+    The raw power levels of joined rooms are kept from sync responses, see `parse_body`.
+    """
+    async def send(
+        self, method: str, path: str, data: Any = None, headers: Optional[Dict[str, str]] = None,
+        trace_context: Any = None, timeout: Optional[float] = None,
+    ) -> ClientResponse:
+        endpoint = endpoint_for_path(path)
+        label = endpoint_label(path)
+        sent = body_size(data=data)
+        attempt = 0
+        while True:
+            await limiter.acquire(endpoint)
+            start = time.monotonic()
+            try:
+                response = await super().send(method, path, data, headers, trace_context, timeout)
+            except Exception:
+                metrics.observe(endpoint, label, "error", time.monotonic() - start, sent=sent)
+                raise
+            metrics.observe(
+                endpoint, label, response.status, time.monotonic() - start,
+                sent=sent, received=response.content_length or 0,
+            )
+            if response.status != 429:
+                return response
+            try:
+                response_data = await response.json(content_type=None)
+            except ValueError:
+                response_data = None
+            if not limiter.throttled(endpoint, attempt, get_retry_after_ms(response, response_data)):
+                return response
+            response.release()
+            metrics.retry(endpoint, label)
+            attempt += 1
+
+    async def parse_body(self, transport_response: ClientResponse) -> Dict[Any, Any]:
+        """
+        Parse a response body, keeping the power levels content of synced rooms.
+
+        matrix-nio fills in defaults when it parses events, some of which differ from the
+        spec, so the content is copied before that happens.
+        """
+        body = await super().parse_body(transport_response)
+        if transport_response.url.path.endswith("/sync"):
+            rooms = body.get("rooms") or {}
+            for room_id, room in (rooms.get("join") or {}).items():
+                events = (room.get("state") or {}).get("events", []) + (room.get("timeline") or {}).get("events", [])
+                for event in events:
+                    if event.get("type") == "m.room.power_levels" and event.get("state_key") == "" \
+                            and isinstance(event.get("content"), dict):
+                        cache.synced_power_levels[room_id] = deepcopy(event["content"])
+            for room_id in rooms.get("leave") or {}:
+                cache.synced_power_levels.pop(room_id, None)
+        return body
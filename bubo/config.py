@@ -63,6 +63,21 @@ class Config(object):
             else:
                 raise ConfigError(f"storage.store_filepath '{self.store_filepath}' is not a directory")
 
+        # Undecryptable events kept for decrypting later
+        self.encrypted_events_ttl = self._get_cfg(
+            ["storage", "encrypted_events", "ttl_hours"], default=72, required=False,
+        ) * 3600
+        self.encrypted_events_max = self._get_cfg(
+            ["storage", "encrypted_events", "max_events"], default=10000, required=False,
+        )
+        self.encrypted_events_prune_interval = self._get_cfg(
+            ["storage", "encrypted_events", "prune_interval_minutes"], default=60, required=False,
+        ) * 60
+        # Room state snapshots older than this are refreshed from the homeserver
+        self.room_state_max_age = self._get_cfg(
+            ["storage", "room_state_max_age_minutes"], default=1440, required=False,
+        ) * 60
+
         # Matrix bot account setup
         self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
         if not re.match("@.*:.*", self.user_id):
@@ -78,9 +93,52 @@ class Config(object):
         self.homeserver_url = self._get_cfg(["matrix", "homeserver_url"], required=True)
         self.server_name = self._get_cfg(["matrix", "server_name"], required=True)
         self.is_synapse_admin = self._get_cfg(["matrix", "is_synapse_admin"], required=False, default=False)
+        self.synapse_admin_concurrency = self._get_cfg(
+            ["matrix", "synapse_admin_concurrency"], required=False, default=10,
+        )
+        if not isinstance(self.synapse_admin_concurrency, int) or self.synapse_admin_concurrency < 1:
+            raise ConfigError("matrix.synapse_admin_concurrency must be a positive integer")
 
         self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
 
+        # Metrics about requests to other services, served in the Prometheus format
+        self.metrics_enabled = self._get_cfg(["metrics", "enabled"], default=False, required=False)
+        self.metrics_host = self._get_cfg(["metrics", "host"], default="127.0.0.1", required=False)
+        self.metrics_port = self._get_cfg(["metrics", "port"], default=9101, required=False)
+
+        # Short lived cache of room details, state and members fetched from the homeserver
+        self.cache_ttl = self._get_cfg(["cache", "ttl_seconds"], default=60, required=False)
+        self.cache_max_entries = self._get_cfg(["cache", "max_entries"], default=1000, required=False)
+
+        # Rate limits per endpoint class, see bubo.ratelimit
+        self.ratelimit_max_retries = self._get_cfg(["ratelimit", "max_retries"], default=5, required=False)
+        self.ratelimit_background_share = self._get_cfg(
+            ["ratelimit", "background_share"], default=0.5, required=False,
+        )
+        self.ratelimit_endpoints = {}
+        for endpoint, limits in self._get_cfg(["ratelimit", "endpoints"], default={}, required=False).items():
+            if "per_second" not in limits or "burst" not in limits:
+                raise ConfigError(f"ratelimit.endpoints.{endpoint} must have per_second and burst")
+            self.ratelimit_endpoints[endpoint] = (limits["per_second"], limits["burst"])
+
+        # Reconnecting to the homeserver after sync fails, see bubo.supervisor
+        self.reconnect_initial_delay = self._get_cfg(
+            ["reconnect", "initial_delay_seconds"], default=1, required=False,
+        )
+        self.reconnect_max_delay = self._get_cfg(["reconnect", "max_delay_seconds"], default=60, required=False)
+        self.reconnect_failure_threshold = self._get_cfg(
+            ["reconnect", "failure_threshold"], default=10, required=False,
+        )
+        self.reconnect_open_seconds = self._get_cfg(["reconnect", "open_seconds"], default=300, required=False)
+
+        # Shared connection pool for HTTP calls made outside matrix-nio
+        self.http_connection_limit = self._get_cfg(["http", "connection_limit"], default=100, required=False)
+        self.http_connection_limit_per_host = self._get_cfg(
+            ["http", "connection_limit_per_host"], default=10, required=False,
+        )
+        self.http_dns_cache_ttl = self._get_cfg(["http", "dns_cache_ttl_seconds"], default=300, required=False)
+        self.http_keepalive_timeout = self._get_cfg(["http", "keepalive_timeout_seconds"], default=30, required=False)
+
         matrix_logging_enabled = self._get_cfg(["logging", "matrix_logging", "enabled"], default=False)
         if matrix_logging_enabled:
             if not self.user_token:
@@ -109,6 +167,21 @@ class Config(object):
 
         # Rooms
         self.rooms = self._get_cfg(["rooms"], default={}, required=False)
+        self.rooms_maintenance_concurrency = self._get_cfg(
+            ["rooms", "maintenance_concurrency"], default=10, required=False,
+        )
+        self.rooms_maintenance_sample_size = self._get_cfg(
+            ["rooms", "maintenance_sample_size"], default=50, required=False,
+        )
+        self.rooms_maintenance_interval = self._get_cfg(
+            ["rooms", "maintenance_interval_seconds"], default=3600, required=False,
+        )
+        self.rooms_maintenance_jitter = self._get_cfg(
+            ["rooms", "maintenance_jitter_seconds"], default=300, required=False,
+        )
+        self.rooms_maintenance_max_runtime = self._get_cfg(
+            ["rooms", "maintenance_max_runtime_seconds"], default=600, required=False,
+        )
 
         # Callbacks
         self.callbacks = self._get_cfg(["callbacks"], default={}, required=False)
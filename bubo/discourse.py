@@ -1,19 +1,18 @@
-import asyncio
 import dataclasses
 import logging
 from typing import Dict
 
-import aiohttp
 # noinspection PyPackageRequirements
 from nio import AsyncClient
 # noinspection PyPackageRequirements
 from slugify import slugify
 
 from bubo.config import Config, load_config
+from bubo.http import request
 from bubo.rooms import (
     ensure_room_exists, add_membership_in_space, add_parent_space, set_join_rules,
 )
-from bubo.storage import Storage
+from bubo.storage import Storage, Room
 
 logger = logging.getLogger(__name__)
 
@@ -26,17 +25,15 @@ class DiscourseClient:
 
     async def do_request(self, method, path, data: Dict = None):
         logger.debug("Making %s request to %s%s", method, self.url, path)
-        async with aiohttp.ClientSession() as session:
-            async with getattr(session, method.lower())(
-                    f"{self.url}{path}",
-                    json=data,
-                    headers=self.request_headers,
-            ) as response:
-                if response.status == 429:
-                    await asyncio.sleep(3)
-                    return await self.do_request(method, path, data)
-                response.raise_for_status()
-                return await response.json()
+        response = await request(
+            method.upper(),
+            f"{self.url}{path}",
+            "discourse",
+            json=data,
+            headers=self.request_headers,
+        )
+        response.raise_for_status()
+        return await response.json()
 
     @property
     def request_headers(self) -> Dict:
@@ -149,110 +146,108 @@ class Discourse:
             dry_run, len(whitelist),
         )
         groups = await self.get_groups()
-        for name, group in groups.items():
-            if whitelist and name not in whitelist:
-                logger.debug("Skipping group %s as it's not in the whitelist")
-                continue
+        # Collect database writes so the whole sync is stored with one commit
+        async with store.batch() as batch:
+            for name, group in groups.items():
+                if whitelist and name not in whitelist:
+                    logger.debug("Skipping group %s as it's not in the whitelist")
+                    continue
+
+                logger.info("Ensuring Discourse group %s has a space", name)
+                group_display_name = group.full_name or group.title or group.short_name
+                space = Room(
+                    name=group_display_name,
+                    alias=group.alias,
+                    title=group.title,
+                    encrypted=False,
+                    public=False,
+                    type="space",
+                )
+                try:
+                    _result, space_id = await ensure_room_exists(
+                        space, client, store, self.config, dry_run=dry_run, batch=batch,
+                    )
+                except Exception as ex:
+                    logger.warning("Failed to ensure group %s exists as a space: %s", name, ex)
+                    continue
 
-            logger.info("Ensuring Discourse group %s has a space", name)
-            group_display_name = group.full_name or group.title or group.short_name
-            room_params = (
-                None,
-                group_display_name,
-                group.alias,
-                None,
-                group.title,
-                None,
-                False,
-                False,
-                "space",
-            )
-            try:
-                _result, space_id = await ensure_room_exists(room_params, client, store, self.config, dry_run=dry_run)
-            except Exception as ex:
-                logger.warning("Failed to ensure group %s exists as a space: %s", name, ex)
-                continue
+                # Add to parent spaces based on prefixes
+                parts = group.name.split('-')
+                if len(parts) > 1:
+                    prefix = parts[0]
+                    prefixes = spaces_config.get("prefixes", {})
+                    if prefix in prefixes.keys():
+                        # Ensure we're a subspace of this parent space
+                        parent_space = prefixes[prefix]
+                        if not dry_run:
+                            await add_membership_in_space(
+                                parent_space=parent_space,
+                                child=space_id,
+                                client=client,
+                                config=self.config,
+                            )
+                            await add_parent_space(
+                                parent_space=parent_space,
+                                child=space_id,
+                                client=client,
+                                config=self.config,
+                                canonical=True
+                            )
+
+                def template_compile(template_str: str) -> str:
+                    result = template_str.replace("%groupdisplayname%", group_display_name)
+                    result = result.replace("%groupname%", group.name)
+                    result = result.replace("%grouptitle%", group.title or "")
+                    result = result.replace("%groupshortname%", group.short_alias)
+                    return result
+
+                # Handle space rooms
+                for room in spaces_config.get("rooms", []):
+                    space_room = Room(
+                        name=template_compile(room.get("templates").get("name")),
+                        alias=template_compile(room.get("templates").get("alias")),
+                        title=template_compile(room.get("templates").get("title")),
+                        encrypted=room.get("encrypted"),
+                        public=room.get("public"),
+                        type="room",
+                    )
+                    try:
+                        _result, room_id = await ensure_room_exists(
+                            space_room, client, store, self.config, dry_run=dry_run, batch=batch,
+                        )
+                    except Exception as ex:
+                        logger.warning(
+                            "Failed to ensure group %s room %s exists: %s",
+                            group.name, room.get("templates").get("name"), ex,
+                        )
+                        continue
 
-            # Add to parent spaces based on prefixes
-            parts = group.name.split('-')
-            if len(parts) > 1:
-                prefix = parts[0]
-                prefixes = spaces_config.get("prefixes", {})
-                if prefix in prefixes.keys():
-                    # Ensure we're a subspace of this parent space
-                    parent_space = prefixes[prefix]
+                    # Maintain memberships
                     if not dry_run:
                         await add_membership_in_space(
-                            parent_space=parent_space,
-                            child=space_id,
+                            parent_space=space_id,
+                            child=room_id,
                             client=client,
                             config=self.config,
+                            suggested=room.get("suggested"),
                         )
                         await add_parent_space(
-                            parent_space=parent_space,
-                            child=space_id,
+                            parent_space=space_id,
+                            child=room_id,
                             client=client,
                             config=self.config,
                             canonical=True
                         )
-
-            def template_compile(template_str: str) -> str:
-                result = template_str.replace("%groupdisplayname%", group_display_name)
-                result = result.replace("%groupname%", group.name)
-                result = result.replace("%grouptitle%", group.title or "")
-                result = result.replace("%groupshortname%", group.short_alias)
-                return result
-
-            # Handle space rooms
-            for room in spaces_config.get("rooms", []):
-                room_params = (
-                    None,
-                    template_compile(room.get("templates").get("name")),
-                    template_compile(room.get("templates").get("alias")),
-                    None,
-                    template_compile(room.get("templates").get("title")),
-                    None,
-                    room.get("encrypted"),
-                    room.get("public"),
-                    "room",
-                )
-                try:
-                    _result, room_id = await ensure_room_exists(
-                        room_params, client, store, self.config, dry_run=dry_run,
-                    )
-                except Exception as ex:
-                    logger.warning(
-                        "Failed to ensure group %s room %s exists: %s",
-                        group.name, room.get("templates").get("name"), ex,
-                    )
-                    continue
-
-                # Maintain memberships
-                if not dry_run:
-                    await add_membership_in_space(
-                        parent_space=space_id,
-                        child=room_id,
-                        client=client,
-                        config=self.config,
-                        suggested=room.get("suggested"),
-                    )
-                    await add_parent_space(
-                        parent_space=space_id,
-                        child=room_id,
-                        client=client,
-                        config=self.config,
-                        canonical=True
-                    )
-                    if room.get("joinable_via_parent", False):
-                        # TODO ensure room version compat
-                        # TODO we may want to also fail if room is public currently
-                        # Set join rules
-                        await set_join_rules(
-                            room_alias_or_id=room_id,
-                            join_rule="restricted",
-                            client=client,
-                            allow=[{
-                                "room_id": space_id,
-                                "type": "m.room_membership",
-                            }]
-                        )
+                        if room.get("joinable_via_parent", False):
+                            # TODO ensure room version compat
+                            # TODO we may want to also fail if room is public currently
+                            # Set join rules
+                            await set_join_rules(
+                                room_alias_or_id=room_id,
+                                join_rule="restricted",
+                                client=client,
+                                allow=[{
+                                    "room_id": space_id,
+                                    "type": "m.room_membership",
+                                }]
+                            )
@@ -7,6 +7,7 @@ Available commands:
 * groupjoin - Alias for `groupinvite`
 * invite - Invite one or more users to a room
 * join - Join a user to a room
+* maintenance - Show how the last room maintenance went
 * power - Set power levels in rooms
 * rooms - List and manage rooms
 * spaces - List and manage spaces
@@ -87,6 +88,13 @@ Otherwise, a normal onvitation is used.
 This command requires coordinator level permissions.
 """
 
+HELP_MAINTENANCE = """Show when room maintenance last ran, how long it took and what it did.
+
+Bubo maintains the rooms it tracks in the background, on startup and then periodically.
+
+This command requires admin level permissions.
+"""
+
 HELP_POWER = """Set power level in a room. Usage:
 
 `power <user> <room> [<level>]`
@@ -0,0 +1,104 @@
+import logging
+import time
+from typing import Optional, Dict
+
+import aiohttp
+
+from bubo.config import Config
+from bubo.metrics import metrics, endpoint_label, body_size
+from bubo.ratelimit import limiter
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager:
+    """
+    Owns the aiohttp session used for HTTP calls made outside matrix-nio.
+
+    Synapse admin, direct C2S and Discourse calls all share one connection pool, so
+    bulk operations reuse warm keep-alive connections instead of opening a new
+    TCP/TLS connection per call.
+    """
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.limit = 100
+        self.limit_per_host = 10
+        self.dns_cache_ttl = 300
+        self.keepalive_timeout = 30
+
+    def configure(self, config: Config):
+        self.limit = config.http_connection_limit
+        self.limit_per_host = config.http_connection_limit_per_host
+        self.dns_cache_ttl = config.http_dns_cache_ttl
+        self.keepalive_timeout = config.http_keepalive_timeout
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            logger.debug(
+                "Creating HTTP session with a limit of %s connections, %s per host",
+                self.limit, self.limit_per_host,
+            )
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+sessions = SessionManager()
+
+
+async def get_session() -> aiohttp.ClientSession:
+    return await sessions.get_session()
+
+
+def get_retry_after_ms(response: aiohttp.ClientResponse, data: Optional[Dict]) -> Optional[int]:
+    if isinstance(data, dict) and data.get("retry_after_ms"):
+        return int(data["retry_after_ms"])
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return int(retry_after) * 1000
+
+
+async def request(method: str, url: str, endpoint: str, **kwargs) -> aiohttp.ClientResponse:
+    """
+    Make a rate limited request with the shared session.
+
+    `endpoint` is the rate limiting class of the request, see `bubo.ratelimit`. The response
+    body is read before returning, so `json()` and `text()` can be used on the returned
+    response. Throttled requests are retried after waiting as long as the server asks. Once
+    retries run out, the 429 response is returned.
+    """
+    session = await get_session()
+    label = endpoint_label(url)
+    sent = body_size(kwargs.get("json"), kwargs.get("data"))
+    attempt = 0
+    while True:
+        await limiter.acquire(endpoint)
+        start = time.monotonic()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.read()
+        except Exception:
+            metrics.observe(endpoint, label, "error", time.monotonic() - start, sent=sent)
+            raise
+        metrics.observe(endpoint, label, response.status, time.monotonic() - start, sent=sent, received=len(body))
+        if response.status != 429:
+            return response
+        try:
+            data = await response.json(content_type=None)
+        except ValueError:
+            data = None
+        if not limiter.throttled(endpoint, attempt, get_retry_after_ms(response, data)):
+            return response
+        metrics.retry(endpoint, label)
+        attempt += 1
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+
+from bubo.config import Config
+from bubo.ratelimit import background
+from bubo.rooms import maintain_configured_rooms
+from bubo.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class MaintenanceScheduler:
+    """
+    Runs room maintenance in the background.
+
+    The first run starts once the client has synced, later runs every
+    `rooms.maintenance_interval_seconds` plus a random jitter. Requests made by
+    maintenance are limited to the background share of each rate limit.
+
+    The outcome of the last run is available for the `maintenance` command.
+    """
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+        self.last_started: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_totals: Optional[Dict[str, int]] = None
+        self.last_error: Optional[str] = None
+        self.next_run: Optional[float] = None
+
+    def start(self, client: AsyncClient, store: Storage, config: Config) -> asyncio.Task:
+        if not self.task or self.task.done():
+            self.task = asyncio.ensure_future(self.run_forever(client, store, config))
+        return self.task
+
+    async def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run_forever(self, client: AsyncClient, store: Storage, config: Config):
+        background.set(True)
+        # Maintenance works on what sync has told about the rooms, so wait for a sync first
+        await client.synced.wait()
+        while True:
+            await self.run(client, store, config)
+            delay = config.rooms_maintenance_interval + random.uniform(0, config.rooms_maintenance_jitter)
+            self.next_run = time.time() + delay
+            await asyncio.sleep(delay)
+
+    async def run(self, client: AsyncClient, store: Storage, config: Config):
+        self.running = True
+        self.last_started = time.time()
+        start = time.monotonic()
+        try:
+            self.last_totals = await maintain_configured_rooms(
+                client, store, config, max_runtime=config.rooms_maintenance_max_runtime,
+            )
+            self.last_error = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            logger.exception("Room maintenance failed")
+            self.last_totals = None
+            self.last_error = str(ex) or type(ex).__name__
+        finally:
+            self.running = False
+            self.last_duration = time.monotonic() - start
+
+    def status(self) -> str:
+        """A summary of the last maintenance run"""
+        if self.last_started is None:
+            return "Room maintenance has not run yet, it will start once Bubo has synced."
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_started))
+        if self.running:
+            return f"Room maintenance is running, started at {started}."
+        lines = [f"Last room maintenance started at {started} and took {self.last_duration:.1f}s."]
+        if self.last_error:
+            lines.append(f"It failed: {self.last_error}")
+        else:
+            totals = self.last_totals
+            lines.append(
+                f"Rooms checked: {totals['checked']}, created: {totals['created']}, "
+                f"power levels fixed: {totals['power_levels_fixed']}, failed: {totals['failed']}, "
+                f"left for the next run: {totals['skipped']}."
+            )
+        if self.next_run:
+            lines.append(f"Next run at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.next_run))}.")
+        return "\n\n".join(lines)
+
+
+scheduler = MaintenanceScheduler()
@@ -0,0 +1,213 @@
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import unquote, urlparse
+
+import requests
+from aiohttp import web
+
+from bubo import cache
+from bubo.config import Config
+from bubo.ratelimit import limiter
+
+logger = logging.getLogger(__name__)
+
+# Request duration histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+UUID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE)
+
+
+def endpoint_label(url: str) -> str:
+    """
+    Turn a request URL into a logical endpoint by replacing IDs in the path with {}.
+    """
+    parts = []
+    for part in urlparse(url).path.split("/"):
+        decoded = unquote(part)
+        if decoded[:1] in ("!", "@", "#", "$", "+") or ":" in decoded or decoded.isdigit() \
+                or UUID_RE.match(decoded):
+            parts.append("{}")
+        else:
+            parts.append(part)
+    return "/".join(parts)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    """
+    Metrics about requests Bubo makes to other services.
+
+    Requests are labelled by service and logical endpoint. For requests to the homeserver
+    and requests made with the shared HTTP session the service is the rate limiting class
+    of the request.
+    """
+    def __init__(self):
+        self.durations: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.responses: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        self.retries: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.bytes_sent: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.bytes_received: Dict[Tuple[str, str], int] = defaultdict(int)
+
+    def observe(
+        self, service: str, endpoint: str, status: Union[int, str], duration: float,
+        sent: int = 0, received: int = 0,
+    ):
+        """
+        Record a finished request.
+
+        Status is the HTTP status code, or "error" if the request raised.
+        """
+        key = (service, endpoint)
+        self.durations[key].observe(duration)
+        self.responses[(service, endpoint, str(status))] += 1
+        self.bytes_sent[key] += sent
+        self.bytes_received[key] += received
+
+    def retry(self, service: str, endpoint: str):
+        self.retries[(service, endpoint)] += 1
+
+    @contextmanager
+    def timed(self, service: str, endpoint: str) -> Iterator:
+        """
+        Time a call to a client library that doesn't expose the HTTP response.
+        """
+        start = time.monotonic()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self.observe(service, endpoint, status, time.monotonic() - start)
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text format.
+        """
+        lines = []
+
+        def labels(**kwargs) -> str:
+            values = ",".join(f'{name}="{value}"' for name, value in kwargs.items())
+            return "{" + values + "}"
+
+        def counter(name: str, description: str, values: List[Tuple[Dict, int]]):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for label_values, value in values:
+                lines.append(f"{name}{labels(**label_values)} {value}")
+
+        name = "bubo_request_duration_seconds"
+        lines.append(f"# HELP {name} Time spent on requests to other services.")
+        lines.append(f"# TYPE {name} histogram")
+        for (service, endpoint), histogram in sorted(self.durations.items()):
+            for bound, count in zip(BUCKETS, histogram.buckets):
+                lines.append(f"{name}_bucket{labels(service=service, endpoint=endpoint, le=bound)} {count}")
+            lines.append(f"{name}_bucket{labels(service=service, endpoint=endpoint, le='+Inf')} {histogram.count}")
+            lines.append(f"{name}_sum{labels(service=service, endpoint=endpoint)} {histogram.sum}")
+            lines.append(f"{name}_count{labels(service=service, endpoint=endpoint)} {histogram.count}")
+
+        counter(
+            "bubo_responses_total", "Responses from other services by status.",
+            [({"service": s, "endpoint": e, "status": st}, v) for (s, e, st), v in sorted(self.responses.items())],
+        )
+        counter(
+            "bubo_throttled_responses_total", "Responses with status 429.",
+            [({"service": s, "endpoint": e}, v) for (s, e, st), v in sorted(self.responses.items()) if st == "429"],
+        )
+        counter(
+            "bubo_server_error_responses_total", "Responses with a 5xx status.",
+            [({"service": s, "endpoint": e}, v) for (s, e, st), v in sorted(self.responses.items())
+             if st.startswith("5")],
+        )
+        counter(
+            "bubo_request_retries_total", "Requests retried after being rate limited.",
+            [({"service": s, "endpoint": e}, v) for (s, e), v in sorted(self.retries.items())],
+        )
+        counter(
+            "bubo_request_sent_bytes_total", "Request body bytes sent.",
+            [({"service": s, "endpoint": e}, v) for (s, e), v in sorted(self.bytes_sent.items())],
+        )
+        counter(
+            "bubo_request_received_bytes_total", "Response body bytes received.",
+            [({"service": s, "endpoint": e}, v) for (s, e), v in sorted(self.bytes_received.items())],
+        )
+        for counter_name in ("requests", "throttled", "gave_up"):
+            counter(
+                f"bubo_ratelimit_{counter_name}_total", f"Rate limiter {counter_name.replace('_', ' ')} count.",
+                [({"class": c}, v[counter_name]) for c, v in sorted(limiter.counters.items())],
+            )
+        counter(
+            "bubo_cache_hits_total", "Lookups answered from a cache.",
+            [({"cache": c.name}, c.hits) for c in cache.caches],
+        )
+        counter(
+            "bubo_cache_misses_total", "Lookups not found in a cache.",
+            [({"cache": c.name}, c.misses) for c in cache.caches],
+        )
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def body_size(json_data=None, data=None) -> int:
+    if json_data is not None:
+        return len(json.dumps(json_data))
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    return 0
+
+
+def timed_request(service: str, method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Make a request with `requests`, recording metrics for it.
+    """
+    endpoint = endpoint_label(url)
+    sent = body_size(kwargs.get("json"), kwargs.get("data"))
+    start = time.monotonic()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except Exception:
+        metrics.observe(service, endpoint, "error", time.monotonic() - start, sent=sent)
+        raise
+    metrics.observe(
+        service, endpoint, response.status_code, time.monotonic() - start, sent=sent, received=len(response.content),
+    )
+    return response
+
+
+async def start_server(config: Config) -> Optional[web.AppRunner]:
+    """
+    Start serving metrics in the Prometheus format, if enabled in config.
+    """
+    if not config.metrics_enabled:
+        return
+
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.metrics_host, config.metrics_port)
+    await site.start()
+    logger.info("Serving metrics at http://%s:%s/metrics", config.metrics_host, config.metrics_port)
+    return runner
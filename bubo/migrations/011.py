@@ -0,0 +1,20 @@
+def forward(cursor):
+    # rooms.alias, rooms.room_id and encrypted_events.event_id are already covered by
+    # their unique constraints. Index the remaining lookup columns, dropping duplicates
+    # first. Lookups used to return the first row inserted, so that is the one we keep.
+    cursor.execute("""
+        DELETE FROM breakout_rooms WHERE id NOT IN (
+            SELECT min(id) FROM breakout_rooms GROUP BY event_id
+        )
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX breakout_rooms_event_id_idx on breakout_rooms (event_id);
+    """)
+    cursor.execute("""
+        DELETE FROM recreate_rooms WHERE id NOT IN (
+            SELECT min(id) FROM recreate_rooms GROUP BY room_id
+        )
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX recreate_rooms_room_id_idx on recreate_rooms (room_id);
+    """)
@@ -0,0 +1,31 @@
+import json
+import time
+
+
+def forward(cursor):
+    cursor.execute("""
+        ALTER TABLE encrypted_events
+            ADD timestamp integer default 0
+    """)
+    # Existing events get a full retention period from now on
+    cursor.execute("""
+        UPDATE encrypted_events SET timestamp = ?
+    """, (int(time.time()),))
+    cursor.execute("""
+        CREATE INDEX encrypted_events_timestamp_idx on encrypted_events (timestamp);
+    """)
+    # Only the event source is needed to restore the event, drop the rest
+    rows = cursor.execute("""
+        SELECT id, event FROM encrypted_events
+    """).fetchall()
+    for row_id, event in rows:
+        try:
+            source = json.loads(event)["source"]
+        except (KeyError, TypeError, ValueError):
+            cursor.execute("""
+                DELETE FROM encrypted_events WHERE id = ?
+            """, (row_id,))
+            continue
+        cursor.execute("""
+            UPDATE encrypted_events SET event = ? WHERE id = ?
+        """, (json.dumps(source), row_id))
@@ -0,0 +1,11 @@
+def forward(cursor):
+    cursor.execute("""
+        CREATE TABLE room_state (
+            id INTEGER PRIMARY KEY autoincrement,
+            room_id text,
+            type text,
+            content text,
+            timestamp integer,
+            constraint room_state_room_id_type_unique_idx unique (room_id, type)
+        )
+    """)
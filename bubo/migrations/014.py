@@ -0,0 +1,10 @@
+def forward(cursor):
+    # Existing rooms start out dirty, so each of them is maintained once more
+    cursor.execute("""
+        ALTER TABLE rooms
+            ADD dirty integer default 1
+    """)
+    cursor.execute("""
+        ALTER TABLE rooms
+            ADD maintained_at integer default 0
+    """)
@@ -0,0 +1,72 @@
+# The database schema as it is after all migrations have run.
+# Fresh databases are created from this directly instead of replaying every migration.
+# When adding a migration, update this schema and `schema_version` to match.
+schema_version = 14
+
+schema = """
+    CREATE TABLE database_version (version INTEGER);
+
+    CREATE TABLE sync_token (
+        dedupe_id INTEGER PRIMARY KEY,
+        token TEXT NOT NULL
+    );
+
+    CREATE TABLE rooms (
+        id INTEGER PRIMARY KEY autoincrement,
+        name text,
+        alias text constraint room_alias_unique_idx unique,
+        room_id text null constraint room_room_id_unique_idx unique,
+        title text default '',
+        icon text default '',
+        encrypted integer,
+        public integer,
+        type text default '',
+        dirty integer default 1,
+        maintained_at integer default 0
+    );
+
+    -- Left over from communities support, kept so fresh and migrated databases match
+    CREATE TABLE community_rooms (
+        id INTEGER PRIMARY KEY autoincrement,
+        room_id integer,
+        community_id integer,
+        constraint room_community_unique_idx unique (room_id, community_id)
+    );
+
+    CREATE TABLE breakout_rooms (
+        id INTEGER PRIMARY KEY autoincrement,
+        event_id text,
+        room_id text
+    );
+    CREATE UNIQUE INDEX breakout_rooms_event_id_idx on breakout_rooms (event_id);
+
+    CREATE TABLE recreate_rooms (
+        id INTEGER PRIMARY KEY autoincrement,
+        requester text,
+        room_id text,
+        timestamp integer,
+        applied integer default 0
+    );
+    CREATE UNIQUE INDEX recreate_rooms_room_id_idx on recreate_rooms (room_id);
+
+    CREATE TABLE encrypted_events (
+        id INTEGER PRIMARY KEY autoincrement,
+        device_id text,
+        event_id text unique,
+        room_id text,
+        session_id text,
+        event text,
+        timestamp integer default 0
+    );
+    CREATE INDEX encrypted_events_session_id_idx on encrypted_events (session_id);
+    CREATE INDEX encrypted_events_timestamp_idx on encrypted_events (timestamp);
+
+    CREATE TABLE room_state (
+        id INTEGER PRIMARY KEY autoincrement,
+        room_id text,
+        type text,
+        content text,
+        timestamp integer,
+        constraint room_state_room_id_type_unique_idx unique (room_id, type)
+    );
+"""
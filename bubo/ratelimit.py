@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import re
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from bubo.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Requests are limited per endpoint class, each with their own token bucket.
+# Defaults are requests per second and burst size, overridable in the `ratelimit` config.
+ENDPOINT_DEFAULTS = {
+    "admin": (20, 20),
+    "client": (10, 20),
+    "discourse": (5, 10),
+    "membership": (5, 10),
+    "messages": (5, 10),
+    # Syncs are long polls made one at a time, so they are not limited
+    "sync": (0, 1),
+}
+
+# Homeserver request paths that don't fall into the default "client" class
+PATH_ENDPOINTS = (
+    (re.compile(r"/sync$"), "sync"),
+    (re.compile(r"/join/[^/]+$|/rooms/[^/]+/(invite|join|kick|leave)$"), "membership"),
+    (re.compile(r"/rooms/[^/]+/send/"), "messages"),
+)
+
+# How long to wait when throttled without the server telling us, in milliseconds
+DEFAULT_RETRY_AFTER_MS = 3000
+
+# Set for background work, such as scheduled room maintenance. Background requests are
+# limited to a share of each endpoint class rate, leaving the rest for commands.
+background: ContextVar[bool] = ContextVar("background", default=False)
+
+
+class TokenBucket:
+    """
+    Token bucket that suspends callers until a request is allowed.
+
+    A rate of zero means unlimited, but callers still wait while the bucket is paused
+    after the server has asked us to slow down.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if not self.rate:
+                    return
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Shared rate limiter for all requests Bubo makes.
+
+    Keeps throttle counters per endpoint class, available from `counters`.
+    """
+    def __init__(self):
+        self.max_retries = 5
+        self.background_share = 0.5
+        self.limits = dict(ENDPOINT_DEFAULTS)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: {
+            "requests": 0,
+            "throttled": 0,
+            "gave_up": 0,
+        })
+
+    def configure(self, config: Config):
+        self.max_retries = config.ratelimit_max_retries
+        self.background_share = config.ratelimit_background_share
+        for endpoint, limits in config.ratelimit_endpoints.items():
+            self.limits[endpoint] = limits
+        self.buckets = {}
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        if endpoint not in self.buckets:
+            rate, burst = self.limits.get(endpoint, ENDPOINT_DEFAULTS["client"])
+            self.buckets[endpoint] = TokenBucket(rate, burst)
+        return self.buckets[endpoint]
+
+    def background_bucket(self, endpoint: str) -> TokenBucket:
+        key = f"{endpoint}:background"
+        if key not in self.buckets:
+            rate, burst = self.limits.get(endpoint, ENDPOINT_DEFAULTS["client"])
+            self.buckets[key] = TokenBucket(rate * self.background_share, int(burst * self.background_share))
+        return self.buckets[key]
+
+    async def acquire(self, endpoint: str):
+        if background.get():
+            await self.background_bucket(endpoint).acquire()
+        await self.bucket(endpoint).acquire()
+        self.counters[endpoint]["requests"] += 1
+
+    def throttled(self, endpoint: str, attempt: int, retry_after_ms: Optional[int] = None) -> bool:
+        """
+        Record a throttled request and pause the endpoint class for the time the server asked for.
+
+        Returns whether the request should be retried, which is until it has been retried
+        `ratelimit.max_retries` times.
+        """
+        self.counters[endpoint]["throttled"] += 1
+        if attempt >= self.max_retries:
+            self.counters[endpoint]["gave_up"] += 1
+            logger.warning("Rate limited on %s requests, giving up after %s retries", endpoint, attempt)
+            return False
+        retry_after_ms = retry_after_ms or DEFAULT_RETRY_AFTER_MS
+        logger.info("Rate limited on %s requests, waiting %sms", endpoint, retry_after_ms)
+        self.bucket(endpoint).pause(retry_after_ms / 1000)
+        return True
+
+
+def endpoint_for_path(path: str) -> str:
+    """Get the endpoint class of a homeserver request path"""
+    path = path.split("?", 1)[0]
+    for pattern, endpoint in PATH_ENDPOINTS:
+        if pattern.search(path):
+            return endpoint
+    return "client"
+
+
+limiter = RateLimiter()
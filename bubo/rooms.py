@@ -2,9 +2,8 @@ import asyncio
 import logging
 import time
 from copy import deepcopy
-from typing import Tuple, Optional, List, Dict, Union
+from typing import Tuple, Optional, List, Dict, Set, Union
 
-import aiohttp
 from aiohttp import ClientResponse
 # noinspection PyPackageRequirements
 from nio import (
@@ -17,11 +16,15 @@ from nio.http import TransportResponse
 # noinspection PyProtectedMember, PyPackageRequirements
 from nio.responses import RoomPutAliasError, RoomDeleteAliasError
 
-from bubo import synapse_admin
+from bubo import cache, synapse_admin
 from bubo.chat_functions import invite_to_room, send_text_to_room, send_text_to_room_c2s
 from bubo.config import Config
-from bubo.storage import Storage
-from bubo.utils import with_ratelimit, get_users_for_access, ensure_room_id
+from bubo.http import request
+from bubo.storage import Storage, StorageBatch, Room, ROOM_STATE_TYPES
+from bubo.utils import (
+    get_users_for_access, ensure_room_id, get_joined_members, get_access_sets, get_synced_room,
+    get_synced_power_levels,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -122,9 +125,7 @@ async def create_breakout_room(
     Create a breakout room.
     """
     logger.info(f"Attempting to create breakout room '{name}'")
-    response = await with_ratelimit(
-        client,
-        "room_create",
+    response = await client.room_create(
         name=name,
         visibility=RoomVisibility.private,
     )
@@ -139,36 +140,43 @@ async def create_breakout_room(
 
 
 async def delete_user_room_tag(
-    config: Config, session: aiohttp.ClientSession, user: str, room_id: str, token: str, tag: str,
+    config: Config, user: str, room_id: str, token: str, tag: str,
 ) -> bool:
-    async with session.delete(
-            f"{config.homeserver_url}/_matrix/client/r0/user/{user}/rooms/{room_id}/tags/{tag}",
-            headers={
-                "Authorization": f"Bearer {token}",
-            },
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await delete_user_room_tag(config, session, user, room_id, token, tag)
-        try:
-            response.raise_for_status()
-            logger.debug("Delete room tag for user: %s, %s, %s", user, room_id, tag)
-            return True
-        except Exception as ex:
-            logger.warning("Failed to delete room tag %s for user %s for room %s: %s", tag, user, room_id, ex)
-            return False
+    response = await request(
+        "DELETE",
+        f"{config.homeserver_url}/_matrix/client/r0/user/{user}/rooms/{room_id}/tags/{tag}",
+        "client",
+        headers={
+            "Authorization": f"Bearer {token}",
+        },
+    )
+    try:
+        response.raise_for_status()
+        logger.debug("Delete room tag for user: %s, %s, %s", user, room_id, tag)
+        return True
+    except Exception as ex:
+        logger.warning("Failed to delete room tag %s for user %s for room %s: %s", tag, user, room_id, ex)
+        return False
 
 
 async def ensure_room_power_levels(
-        room_id: str, client: AsyncClient, config: Config, members: List,
-):
+        room_id: str, client: AsyncClient, store: Storage, config: Config, members: List,
+        coordinators: Set[str] = None,
+) -> Optional[bool]:
     """
     Ensure room has correct power levels.
+
+    When ensuring many rooms, resolve the coordinators once and pass them in.
+
+    Returns whether the power levels were changed, or None if they could not be read or updated.
     """
     logger.debug(f"Ensuring power levels: {room_id}")
-    state, users = await get_room_power_levels(client, room_id)
+    content, users = await get_room_power_levels(client, store, config, room_id)
+    if content is None:
+        return None
     member_ids = {member.user_id for member in members}
-    coordinators = await get_users_for_access(client, config, "coordinators")
+    if coordinators is None:
+        coordinators = await get_users_for_access(client, config, "coordinators")
 
     # check existing users
     for mxid, level in users.items():
@@ -194,45 +202,56 @@ async def ensure_room_power_levels(
                 users[user] = 50
 
     power_levels = config.rooms.get("power_levels") if config.rooms.get("enforce_power_in_old_rooms", True) else {}
-    new_power = deepcopy(state.content)
+    new_power = deepcopy(content)
     new_power.update(power_levels)
     new_power["users"] = users
 
-    if state.content != new_power:
+    if content != new_power:
         logger.info(f"Updating room {room_id} power levels")
-        response = await with_ratelimit(
-            client,
-            "room_put_state",
+        response = await client.room_put_state(
             room_id=room_id,
             event_type="m.room.power_levels",
             content=new_power,
         )
         logger.debug(f"Power levels update response: {response}")
+        cache.state_changed(room_id, "m.room.power_levels")
+        if isinstance(response, RoomPutStateResponse):
+            await store.store_room_state(room_id, "m.room.power_levels", new_power)
+            return True
+        logger.warning(f"Failed to update room {room_id} power levels: {response}")
+        return None
+    return False
 
 
 async def ensure_room_exists(
-        room: tuple, client: AsyncClient, store: Storage, config: Config, dry_run: bool = False,
+        room: Room, client: AsyncClient, store: Storage, config: Config, dry_run: bool = False,
+        batch: StorageBatch = None, power_levels: bool = True,
 ) -> Tuple[str, str]:
     """
     Maintains a room.
 
+    If a batch is given, database writes are collected to it instead of written directly.
+    With `power_levels` false, ensuring the room power levels is left to the caller.
+
     Returns a tuple of:
       - created/exists string
       - room_id
     """
-    dbid, name, alias, room_id, title, icon, encrypted, public, room_type = room
-    if room_type not in ("space", "room"):
-        room_type = "room"
+    dbid = room.id
+    room_id = room.room_id
+    name, alias, title = room.name, room.alias, room.title
+    encrypted, public = room.encrypted, room.public
+    room_type = room.type if room.type in ("space", "room") else "room"
     logger.debug("Ensuring %s: %s", room_type, room)
     room_created = False
     logger.info("Ensuring %s %s (%s) exists", room_type, name, alias)
 
     if not dbid:
         # Check if we track this room already
-        db_room = store.get_room_by_alias(alias)
+        db_room = await store.get_room_by_alias(alias)
         if db_room:
-            dbid = db_room[0]
-            room_id = db_room[3]
+            dbid = db_room.id
+            room_id = db_room.room_id
             logger.info("%s %s found in the database as %s", room_type.capitalize(), name, room_id)
 
     if not room_id:
@@ -265,31 +284,24 @@ async def ensure_room_exists(
                     logger.info(f"Room '{alias}' created at {room_id}")
                     room_created = True
                 else:
-                    if response.status_code == "M_LIMIT_EXCEEDED":
-                        # Wait and try again
-                        logger.info("Hit request limits, waiting 3 seconds...")
-                        time.sleep(3)
-                        return await ensure_room_exists(room, client, store, config)
                     raise Exception(f"Could not create room: {response.message}, {response.status_code}")
             else:
                 logger.info("Not creating %s '%s' due to dry run", room_type, alias)
         if not dry_run:
+            writer = batch or store
             if dbid:
                 # Store room ID
-                store.cursor.execute("""
-                    update rooms set room_id = ? where id = ?
-                """, (room_id, dbid))
-                store.conn.commit()
+                await writer.set_room_id(alias, room_id)
                 logger.info("%s '%s' room ID stored to database", room_type.capitalize(), alias)
             else:
-                store.store_room(name, alias, room_id, title, encrypted, public, room_type)
+                await writer.store_room(name, alias, room_id, title, encrypted, public, room_type)
                 logger.info("%s '%s' creation stored to database", room_type, alias)
 
-    if not dry_run:
-        room_members = await with_ratelimit(client, "joined_members", room_id)
+    if power_levels and not dry_run:
+        room_members = await get_joined_members(client, room_id)
         members = getattr(room_members, "members", [])
 
-        await ensure_room_power_levels(room_id, client, config, members)
+        await ensure_room_power_levels(room_id, client, store, config, members)
 
     if room_created:
         return "created", room_id
@@ -297,60 +309,98 @@ async def ensure_room_exists(
 
 
 async def get_room_power_levels(
-    client: AsyncClient, room_id: str,
-) -> Tuple[Optional[RoomGetStateEventResponse], Optional[Dict]]:
+    client: AsyncClient, store: Storage, config: Config, room_id: str,
+) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """
+    Get the power levels content of a room and a copy of its users.
+    """
     logger.debug(f"Fetching power levels for {room_id}")
-    state = None
-    try:
-        state = await with_ratelimit(client, "room_get_state_event", room_id=room_id, event_type="m.room.power_levels")
-        logger.debug(f"Found power levels state: {state}")
-        users = state.content["users"].copy()
-    except KeyError as ex:
-        logger.warning(f"Error looking for power levels for room {room_id}: {ex} - state: {state}")
+    content = await get_room_state(client, store, config, room_id, "m.room.power_levels")
+    logger.debug(f"Found power levels state: {content}")
+    if not content or "users" not in content:
+        logger.warning(f"Error looking for power levels for room {room_id} - state: {content}")
         return None, None
-    return state, users
+    return content, content["users"].copy()
+
+
+async def get_room_state(
+    client: AsyncClient, store: Storage, config: Config, room_id: str, event_type: str,
+) -> Optional[Dict]:
+    """
+    Get the content of a room state event.
+
+    For rooms tracked by Bubo, a local snapshot is used. Sync keeps the snapshots of rooms
+    Bubo is joined to up to date, for other rooms the snapshot is used unless it is older
+    than the configured maximum age. Power levels of untracked rooms Bubo is joined to
+    come from sync. Otherwise, or if Bubo has changed the state and sync has not yet
+    delivered the change, the state is fetched from the homeserver and the snapshot
+    refreshed. Fetched state is also cached for a short while.
+    """
+    synced = get_synced_room(client, room_id)
+    tracked = event_type in ROOM_STATE_TYPES and await store.get_room(room_id)
+    unsynced = (room_id, event_type) in cache.unsynced_state
+    if tracked and not unsynced:
+        snapshot = await store.get_room_state(room_id, event_type)
+        if snapshot:
+            content, timestamp = snapshot
+            if synced or time.time() - timestamp < config.room_state_max_age:
+                return content
+    if synced and not unsynced and event_type == "m.room.power_levels":
+        content = get_synced_power_levels(client, room_id)
+        if content:
+            return content
+
+    async def fetch() -> Optional[Dict]:
+        response = await client.room_get_state_event(room_id=room_id, event_type=event_type)
+        if not isinstance(response, RoomGetStateEventResponse) or "errcode" in response.content:
+            logger.debug(f"No {event_type} state found for {room_id}: {response}")
+            return None
+        if tracked:
+            await store.store_room_state(room_id, event_type, response.content)
+        return response.content
+
+    # Callers are free to modify the content, so don't hand out the cached copy
+    return deepcopy(await cache.room_state.get((room_id, event_type), fetch))
 
 
 async def get_user_room_tags(
-    config: Config, session: aiohttp.ClientSession, user: str, room_id: str, token: str,
+    config: Config, user: str, room_id: str, token: str,
 ) -> Optional[Dict]:
-    async with session.get(
+    response = await request(
+        "GET",
         f"{config.homeserver_url}/_matrix/client/r0/user/{user}/rooms/{room_id}/tags",
+        "client",
         headers={
             "Authorization": f"Bearer {token}",
         },
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await get_user_room_tags(config, session, user, room_id, token)
-        try:
-            response.raise_for_status()
-            data = await response.json()
-            logger.debug("Got room tags for user: %s, %s, %s", user, room_id, data)
-            return data["tags"]
-        except Exception as ex:
-            logger.warning("Failed to get room tags for user %s for room %s: %s", user, room_id, ex)
-            return
+    )
+    try:
+        response.raise_for_status()
+        data = await response.json()
+        logger.debug("Got room tags for user: %s, %s, %s", user, room_id, data)
+        return data["tags"]
+    except Exception as ex:
+        logger.warning("Failed to get room tags for user %s for room %s: %s", user, room_id, ex)
+        return
 
 
-async def get_room_directory_status(config: Config, session: aiohttp.ClientSession, room_id: str) -> Optional[str]:
-    async with session.get(
+async def get_room_directory_status(config: Config, room_id: str) -> Optional[str]:
+    response = await request(
+        "GET",
         f"{config.homeserver_url}/_matrix/client/r0/directory/list/room/{room_id}",
+        "client",
         headers={
             "Authorization": f"Bearer {config.user_token}",
         },
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await get_room_directory_status(config, session, room_id)
-        try:
-            response.raise_for_status()
-            data = await response.json()
-            logger.debug("Got room directory visibility: %s, %s", room_id, data)
-            return data.get("visibility")
-        except Exception as ex:
-            logger.warning("Failed to get room directory visibility for room %s: %s", room_id, ex)
-            return
+    )
+    try:
+        response.raise_for_status()
+        data = await response.json()
+        logger.debug("Got room directory visibility: %s, %s", room_id, data)
+        return data.get("visibility")
+    except Exception as ex:
+        logger.warning("Failed to get room directory visibility for room %s: %s", room_id, ex)
+        return
 
 
 async def recreate_room(
@@ -364,10 +414,10 @@ async def recreate_room(
         alias = None
         alt_aliases = []
         # Remove aliases from the old room
-        aliases = await client.room_get_state_event(room.room_id, "m.room.canonical_alias")
-        if isinstance(aliases, RoomGetStateEventResponse):
-            alias = aliases.content.get("alias")
-            alt_aliases = aliases.content.get("alt_aliases", [])
+        aliases = await get_room_state(client, store, config, room.room_id, "m.room.canonical_alias")
+        if aliases:
+            alias = aliases.get("alias")
+            alt_aliases = aliases.get("alt_aliases", [])
 
         if alias or alt_aliases:
             logger.info(f"Removing canonical alias {alias} and {len(alt_aliases)} alt aliases from old room")
@@ -383,7 +433,7 @@ async def recreate_room(
             )
 
         # Get room visibility
-        room_visibility = await with_ratelimit(client, "room_get_visibility", room_id=room.room_id)
+        room_visibility = await client.room_get_visibility(room_id=room.room_id)
         logger.debug(f"Room visibility is: {room_visibility}")
 
         # Calculate users
@@ -392,13 +442,13 @@ async def recreate_room(
         users = users.union(invited_users)
 
         # Power levels
-        power_levels, _users = await get_room_power_levels(client, room.room_id)
+        power_levels, _users = await get_room_power_levels(client, store, config, room.room_id)
         # Ensure we don't immediately demote ourselves
-        power_levels.content["users"][config.user_id] = 100
+        power_levels["users"][config.user_id] = 100
         # Add secondary admin if configured
         if config.rooms.get("secondary_admin"):
             users.add(config.rooms.get("secondary_admin"))
-            power_levels.content["users"][config.rooms.get("secondary_admin")] = 100
+            power_levels["users"][config.rooms.get("secondary_admin")] = 100
 
         # Create new room
         local_users = [user for user in users if user.endswith(f":{config.server_name}") and user != config.user_id]
@@ -424,7 +474,7 @@ async def recreate_room(
             topic=room.topic,
             federate=federated,
             initial_state=initial_state,
-            power_level_override=power_levels.content,
+            power_level_override=power_levels,
             predecessor={
                 "event_id": last_event_id,
                 "room_id": room.room_id,
@@ -463,16 +513,17 @@ async def recreate_room(
 
         # If maintained by Bubo, update the database
         if alias and alias.endswith(f":{config.server_name}"):
-            maintained_room_id = store.get_room_id(alias)
+            maintained_room_id = await store.get_room_id(alias)
             if maintained_room_id:
-                store.set_room_id(alias, new_room.room_id)
+                await store.set_room_id(alias, new_room.room_id)
 
         # Various things if Synapse admin for local users
         if config.is_synapse_admin:
             # Try to force join local users
             if local_users:
                 try:
-                    joined_count = await synapse_admin.join_users(config, local_users, new_room.room_id)
+                    results = await synapse_admin.join_users(config, local_users, new_room.room_id)
+                    joined_count = len([reason for reason in results.values() if reason is None])
                     logger.debug(f"Successfully joined {joined_count} local users to new room {new_room.room_id}")
                 except Exception as ex:
                     logger.warning(
@@ -481,21 +532,25 @@ async def recreate_room(
 
             # Get temporary access tokens for the users
             user_tokens = await synapse_admin.get_temporary_user_tokens(config, local_users)
-            async with aiohttp.ClientSession() as session:
-                for user, token in user_tokens.items():
+            semaphore = asyncio.Semaphore(config.synapse_admin_concurrency)
+
+            async def copy_room_tags(user: str, token: str):
+                async with semaphore:
                     logger.debug("Room tag tokens: %s, %s", user, token)
                     # Copy over room tags
-                    tags = await get_user_room_tags(config, session, user, room.room_id, token)
+                    tags = await get_user_room_tags(config, user, room.room_id, token)
                     logger.debug("Got tags: %s", tags)
                     if tags:
                         # Copy to the new room
-                        await set_user_room_tags(config, session, user, new_room.room_id, token, tags)
+                        await set_user_room_tags(config, user, new_room.room_id, token, tags)
                         # Remove favourite from old room
                         if "m.favourite" in tags.keys():
-                            await delete_user_room_tag(config, session, user, room.room_id, token, "m.favourite")
+                            await delete_user_room_tag(config, user, room.room_id, token, "m.favourite")
                     # Mark old room as low priority, if not already
                     if not tags or "m.lowpriority" not in tags.keys():
-                        await set_user_room_tag(config, session, user, room.room_id, token, "m.lowpriority", 0)
+                        await set_user_room_tag(config, user, room.room_id, token, "m.lowpriority", 0)
+
+            await asyncio.gather(*(copy_room_tags(user, token) for user, token in user_tokens.items()))
 
         # Invites, all if not synapse admin, remote if locals were joined already
         invite_users = remote_users
@@ -531,11 +586,10 @@ async def recreate_room(
                     )
 
         # Room directory
-        async with aiohttp.ClientSession() as session:
-            directory_visibility = await get_room_directory_status(config, session, room.room_id)
-            if directory_visibility == "public":
-                await set_room_directory_status(config, session, room.room_id, "private")
-                await set_room_directory_status(config, session, new_room.room_id, "public")
+        directory_visibility = await get_room_directory_status(config, room.room_id)
+        if directory_visibility == "public":
+            await set_room_directory_status(config, room.room_id, "private")
+            await set_room_directory_status(config, new_room.room_id, "public")
 
         # Post a message to the start of the timeline of the new room and the end of the timeline for the
         # old room
@@ -634,9 +688,9 @@ async def set_canonical_alias(
         raise Exception(f"Failed to set canonical alias {alias} for room {room_id}: {response.message}")
 
     # Update Bubo db if needed, assuming this is a locally owned alias
-    room = store.get_room_by_alias(alias)
+    room = await store.get_room_by_alias(alias)
     if room:
-        store.set_room_alias(room_id, alias)
+        await store.set_room_alias(room_id, alias)
 
 
 async def set_join_rules(
@@ -677,27 +731,26 @@ async def set_join_rules(
 
 
 async def set_room_directory_status(
-    config: Config, session: aiohttp.ClientSession, room_id: str, visibility: str,
+    config: Config, room_id: str, visibility: str,
 ) -> bool:
-    async with session.put(
+    response = await request(
+        "PUT",
         f"{config.homeserver_url}/_matrix/client/r0/directory/list/room/{room_id}",
+        "client",
         json={
             "visibility": visibility,
         },
         headers={
             "Authorization": f"Bearer {config.user_token}",
         },
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await set_room_directory_status(config, session, room_id, visibility)
-        try:
-            response.raise_for_status()
-            logger.debug("Room directory visibility has been set: %s, %s", room_id, visibility)
-            return True
-        except Exception as ex:
-            logger.warning("Failed to set room directory visibility for room %s: %s", room_id, ex)
-            return False
+    )
+    try:
+        response.raise_for_status()
+        logger.debug("Room directory visibility has been set: %s, %s", room_id, visibility)
+        return True
+    except Exception as ex:
+        logger.warning("Failed to set room directory visibility for room %s: %s", room_id, ex)
+        return False
 
 
 async def set_user_power(
@@ -724,63 +777,129 @@ async def set_user_power(
         )
         return status_code
     state_response.content["users"][user_id] = power
-    response = await with_ratelimit(
-        client,
-        "room_put_state",
+    response = await client.room_put_state(
         room_id=room_id,
         event_type="m.room.power_levels",
         content=state_response.content,
     )
+    cache.state_changed(room_id, "m.room.power_levels")
     logger.debug(f"Power levels update response: {response}")
     return response
 
 
 async def set_user_room_tag(
-    config: Config, session: aiohttp.ClientSession, user: str, room_id: str, token: str, tag: str, order: float,
+    config: Config, user: str, room_id: str, token: str, tag: str, order: float,
 ) -> bool:
-    async with session.put(
-            f"{config.homeserver_url}/_matrix/client/r0/user/{user}/rooms/{room_id}/tags/{tag}",
-            json={
-                "order": order,
-            },
-            headers={
-                "Authorization": f"Bearer {token}",
-            },
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await set_user_room_tag(config, session, user, room_id, token, tag, order)
-        try:
-            response.raise_for_status()
-            logger.debug("Set room tag for user: %s, %s, %s", user, room_id, tag)
-            return True
-        except Exception as ex:
-            logger.warning("Failed to set room tag %s for user %s for room %s: %s", tag, user, room_id, ex)
-            return False
+    response = await request(
+        "PUT",
+        f"{config.homeserver_url}/_matrix/client/r0/user/{user}/rooms/{room_id}/tags/{tag}",
+        "client",
+        json={
+            "order": order,
+        },
+        headers={
+            "Authorization": f"Bearer {token}",
+        },
+    )
+    try:
+        response.raise_for_status()
+        logger.debug("Set room tag for user: %s, %s, %s", user, room_id, tag)
+        return True
+    except Exception as ex:
+        logger.warning("Failed to set room tag %s for user %s for room %s: %s", tag, user, room_id, ex)
+        return False
 
 
 async def set_user_room_tags(
-    config: Config, session: aiohttp.ClientSession, user: str, room_id: str, token: str, tags: Dict,
+    config: Config, user: str, room_id: str, token: str, tags: Dict,
 ) -> None:
     for tag, data in tags.items():
-        await set_user_room_tag(config, session, user, room_id, token, tag, data.get("order"))
+        await set_user_room_tag(config, user, room_id, token, tag, data.get("order"))
+
+
+async def maintain_room(
+    room: Room, client: AsyncClient, store: Storage, config: Config, batch: StorageBatch, access: Dict[str, Set],
+) -> Dict:
+    """
+    Maintain a single tracked room, returning what was done to it.
+
+    `access` is the users of each access type, see `get_access_sets`. Raises if the room
+    could not be maintained.
+    """
+    result, room_id = await ensure_room_exists(room, client, store, config, batch=batch, power_levels=False)
+    room_members = await get_joined_members(client, room_id)
+    members = getattr(room_members, "members", [])
+    power_levels_fixed = await ensure_room_power_levels(
+        room_id, client, store, config, members, coordinators=access["coordinators"],
+    )
+    if power_levels_fixed is None:
+        raise Exception(f"Failed to ensure power levels of room {room_id}")
+    return {
+        "room_id": room_id,
+        "created": result == "created",
+        "power_levels_fixed": power_levels_fixed,
+    }
 
 
-async def maintain_configured_rooms(client: AsyncClient, store: Storage, config: Config):
+async def maintain_configured_rooms(
+    client: AsyncClient, store: Storage, config: Config, max_runtime: float = None,
+) -> Dict[str, int]:
     """
     Maintains the list of configured rooms.
 
-    Creates if missing. Corrects if details are not correct.
+    Creates if missing. Corrects if details are not correct. Only rooms marked dirty by
+    sync and rooms not yet created are maintained, together with a rolling sample of
+    `rooms.maintenance_sample_size` clean rooms. Rooms are maintained
+    `rooms.maintenance_concurrency` at a time, and a failure in one room doesn't stop
+    the others being maintained. Failed rooms stay dirty.
+
+    With `max_runtime` given, no new rooms are started after that many seconds. Rooms
+    skipped because of it stay as they were, to be maintained on the next run.
+
+    Returns totals of rooms checked, created, with power levels fixed, failed and skipped.
     """
     logger.info("Starting maintaining of rooms")
+    start = time.monotonic()
+    started = int(time.time() * 1000)
+    totals = {
+        "checked": 0,
+        "created": 0,
+        "power_levels_fixed": 0,
+        "failed": 0,
+        "skipped": 0,
+    }
+    deadline = start + max_runtime if max_runtime else None
+    semaphore = asyncio.Semaphore(max(config.rooms_maintenance_concurrency, 1))
 
-    results = store.cursor.execute("""
-        select id, name, alias, room_id, title, icon, encrypted, public, type from rooms
-    """)
+    maintained = []
 
-    rooms = results.fetchall()
-    for room in rooms:
-        try:
-            await ensure_room_exists(room, client, store, config)
-        except Exception as e:
-            logger.error(f"Error with room '{room[2]}': {e}")
+    async def maintain(room: Room):
+        async with semaphore:
+            if deadline and time.monotonic() > deadline:
+                totals["skipped"] += 1
+                return
+            try:
+                result = await maintain_room(room, client, store, config, batch, access)
+            except Exception as e:
+                logger.error(f"Error with room '{room.alias}': {e}")
+                totals["failed"] += 1
+                return
+            maintained.append(result["room_id"])
+            totals["checked"] += 1
+            totals["created"] += result["created"]
+            totals["power_levels_fixed"] += result["power_levels_fixed"]
+
+    rooms = await store.get_rooms_for_maintenance(config.rooms_maintenance_sample_size)
+    # Resolved once for the whole run, instead of for each room
+    access = await get_access_sets(client, config)
+    async with store.batch() as batch:
+        await asyncio.gather(*(maintain(room) for room in rooms))
+    await store.set_rooms_maintained(maintained, started)
+
+    logger.info(
+        "Maintained %s of %s rooms in %.1fs: %s checked, %s created, %s power levels fixed, %s failed, "
+        "%s skipped",
+        len(rooms), len(await store.get_rooms()), time.monotonic() - start, totals["checked"],
+        totals["created"], totals["power_levels_fixed"], totals["failed"], totals["skipped"],
+    )
+    return totals
@@ -1,19 +1,115 @@
+import asyncio
 import json
 import logging
 import time
-from dataclasses import asdict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from importlib import import_module
-from typing import Optional, List
+from typing import Optional, List, Any, Callable, Tuple, Dict, AsyncIterator, Set
 
 import sqlite3
 # noinspection PyPackageRequirements
 from nio import MegolmEvent
 
-latest_db_version = 10
+from bubo.migrations import schema
+
+latest_db_version = 14
+
+# State events of tracked rooms that are kept as local snapshots
+ROOM_STATE_TYPES = (
+    "m.room.canonical_alias",
+    "m.room.create",
+    "m.room.encryption",
+    "m.room.join_rules",
+    "m.room.power_levels",
+)
 
 logger = logging.getLogger(__name__)
 
 
+# Column order of the rooms table as used by Room
+ROOM_COLUMNS = "id, name, alias, room_id, title, icon, encrypted, public, type, dirty, maintained_at"
+
+
+class Record(object):
+    """Base for the slotted records returned by Storage"""
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ", ".join(f"{slot}={getattr(self, slot)!r}" for slot in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class BreakoutRoom(Record):
+    __slots__ = ("id", "event_id", "room_id")
+
+    def __init__(self, id: int, event_id: str, room_id: str):
+        self.id = id
+        self.event_id = event_id
+        self.room_id = room_id
+
+
+class RecreateRequest(Record):
+    __slots__ = ("id", "requester", "room_id", "timestamp", "applied")
+
+    def __init__(self, id: int, requester: str, room_id: str, timestamp: int, applied: int):
+        self.id = id
+        self.requester = requester
+        self.room_id = room_id
+        self.timestamp = timestamp
+        self.applied = applied
+
+
+class Room(Record):
+    __slots__ = (
+        "id", "name", "alias", "room_id", "title", "icon", "encrypted", "public", "type", "dirty", "maintained_at",
+    )
+
+    def __init__(
+        self, id: Optional[int] = None, name: str = None, alias: str = None, room_id: Optional[str] = None,
+        title: str = "", icon: str = "", encrypted: bool = False, public: bool = False, type: str = "room",
+        dirty: int = 1, maintained_at: int = 0,
+    ):
+        """A room tracked by Bubo
+
+        Rooms not yet stored have no id. The alias is the localpart only.
+
+        Dirty rooms need maintenance. `dirty` is the time in milliseconds the room was last
+        marked dirty, or 0 if it is clean. `maintained_at` is when it was last maintained,
+        in seconds.
+        """
+        self.id = id
+        self.name = name
+        self.alias = alias
+        self.room_id = room_id
+        self.title = title
+        self.icon = icon
+        self.encrypted = encrypted
+        self.public = public
+        self.type = type
+        self.dirty = dirty
+        self.maintained_at = maintained_at
+
+
+class StorageBatch(object):
+    def __init__(self):
+        """Room writes collected for a single transaction
+
+        Mirrors the room write methods of Storage, so it can be passed to code
+        that would otherwise write through the store directly. Writes are keyed
+        by alias, a later write to the same alias replaces an earlier one.
+        """
+        self.new_rooms: Dict[str, Tuple] = {}
+        self.room_ids: Dict[str, str] = {}
+
+    async def set_room_id(self, alias: str, room_id: str) -> None:
+        self.room_ids[alias.split(":")[0].strip("#")] = room_id
+
+    async def store_room(self, name, alias, room_id, title, encrypted, public, room_type):
+        self.new_rooms[alias] = (name, alias, room_id, title, encrypted, public, room_type)
+
+
 class Storage(object):
     def __init__(self, db_path):
         """Set up the database
@@ -21,37 +117,69 @@ class Storage(object):
         Runs an initial setup or migrations depending on whether a database file has already
         been created
 
+        Setup and migrations run synchronously on startup. After that all database access
+        goes through the coroutine methods, which run the queries in a single dedicated
+        thread so that the event loop is never blocked on disk.
+
+        Tracked rooms are additionally kept in an in-memory registry, loaded once here
+        and updated by every method writing to the rooms table. Room lookups never hit
+        the database. Likewise the event IDs of breakout room announcements are kept in
+        memory, so that reactions to any other event are rejected without a query.
+
         Args:
             db_path (str): The name of the database file
         """
         self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bubo-storage")
+
+        self._rooms: Dict[int, Room] = {}
+        self._rooms_by_alias: Dict[str, Room] = {}
+        self._rooms_by_room_id: Dict[str, Room] = {}
+        self._breakout_event_ids: Set[str] = set()
 
         self._initial_setup()
         self._run_migrations()
+        self._load_rooms()
+        self._load_breakout_event_ids()
 
     def _initial_setup(self):
         """Initial setup of the database"""
         logger.info("Performing initial database setup...")
 
         # Initialize a connection to the database
-        self.conn = sqlite3.connect(self.db_path)
+        # The connection is created here but used from the storage thread afterwards
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
 
-        # Create database_version table if it doesn't exist
-        try:
-            self.cursor.execute("""
-                CREATE TABLE database_version (version INTEGER)
-            """)
-            self.cursor.execute("""
-                insert into database_version (version) values (0)
-            """)
-            self.conn.commit()
-        except sqlite3.OperationalError:
-            pass
+        # Write-ahead logging lets readers and the writer proceed without blocking each other,
+        # and with synchronous=normal a commit no longer waits for a full fsync
+        self.cursor.execute("pragma journal_mode=wal")
+        self.cursor.execute("pragma synchronous=normal")
+
+        # Create the latest schema directly if this is a new database
+        results = self.cursor.execute("""
+            select name from sqlite_master where type = 'table' and name = 'database_version'
+        """)
+        if not results.fetchone():
+            self._create_schema()
 
         logger.info("Database setup complete")
 
+    def _create_schema(self):
+        """Create the latest database schema in one transaction"""
+        logger.info(f"Creating database schema version {schema.schema_version}")
+        try:
+            self.cursor.executescript(f"""
+                begin;
+                {schema.schema}
+                insert into database_version (version) values ({schema.schema_version});
+                commit;
+            """)
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
     def _run_migrations(self):
         """Execute database migrations"""
         # Get current version of db
@@ -61,141 +189,376 @@ class Storage(object):
             logger.info("No migrations to run")
             return
 
-        while version < latest_db_version:
-            version += 1
-            version_string = str(version).rjust(3, "0")
-            migration = import_module(f"bubo.migrations.{version_string}")
-            # noinspection PyUnresolvedReferences
-            migration.forward(self.cursor)
-            logger.info(f"Executing database migration {version_string}")
+        # Run all pending migrations in one transaction, so a failure leaves the database untouched
+        self.cursor.execute("begin")
+        try:
+            while version < latest_db_version:
+                version += 1
+                version_string = str(version).rjust(3, "0")
+                migration = import_module(f"bubo.migrations.{version_string}")
+                logger.info(f"Executing database migration {version_string}")
+                # noinspection PyUnresolvedReferences
+                migration.forward(self.cursor)
+                logger.info(f"...done")
             # noinspection SqlWithoutWhere
-            self.cursor.execute("update database_version set version = ?", (version_string,))
+            self.cursor.execute("update database_version set version = ?", (version,))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _load_rooms(self):
+        """Load tracked rooms into the in-memory registry"""
+        for row in self.cursor.execute(f"select {ROOM_COLUMNS} from rooms").fetchall():
+            self._cache_room(Room(*row))
+        logger.info(f"Loaded {len(self._rooms)} rooms into the room registry")
+
+    def _load_breakout_event_ids(self):
+        """Load the event IDs of breakout room announcements"""
+        for row in self.cursor.execute("select event_id from breakout_rooms").fetchall():
+            self._breakout_event_ids.add(row["event_id"])
+
+    def _cache_room(self, room: Room) -> None:
+        self._uncache_room(room.id)
+        self._rooms[room.id] = room
+        if room.alias:
+            self._rooms_by_alias[room.alias] = room
+        if room.room_id:
+            self._rooms_by_room_id[room.room_id] = room
+
+    def _uncache_room(self, dbid: int) -> None:
+        old = self._rooms.pop(dbid, None)
+        if not old:
+            return
+        if self._rooms_by_alias.get(old.alias) is old:
+            del self._rooms_by_alias[old.alias]
+        if self._rooms_by_room_id.get(old.room_id) is old:
+            del self._rooms_by_room_id[old.room_id]
+
+    def _write_room_batch(self, new_rooms: List[Tuple], room_ids: List[Tuple[str, str]]) -> List[Room]:
+        """Insert rooms and update room IDs by alias in one transaction
+
+        If the transaction fails, each write is retried in its own transaction so that
+        a single bad row, such as a duplicate alias, only fails itself.
+
+        Returns the affected rooms as they are after the write.
+        """
+        insert_query = """
+            insert into rooms (
+                name, alias, room_id, title, encrypted, public, type
+            ) values (
+                ?, ?, ?, ?, ?, ?, ?
+            )
+        """
+        update_query = """
+            update rooms set room_id = ? where alias = ?;
+        """
+        try:
+            self.conn.executemany(insert_query, new_rooms)
+            self.conn.executemany(update_query, room_ids)
             self.conn.commit()
-            logger.info(f"...done")
+        except sqlite3.Error as ex:
+            self.conn.rollback()
+            logger.warning(f"Failed to store room batch, storing rooms one by one: {ex}")
+            for query, params in [(insert_query, room) for room in new_rooms] + \
+                    [(update_query, room_id) for room_id in room_ids]:
+                try:
+                    self.conn.execute(query, params)
+                    self.conn.commit()
+                except sqlite3.Error as ex:
+                    self.conn.rollback()
+                    logger.error(f"Failed to store room {params[1]}: {ex}")
+        aliases = [room[1] for room in new_rooms] + [alias for _room_id, alias in room_ids]
+        rows = []
+        # Stay well below the SQLite limit of bound parameters per query
+        for i in range(0, len(aliases), 500):
+            chunk = aliases[i:i + 500]
+            rows.extend(self.conn.execute(
+                f"select {ROOM_COLUMNS} from rooms where alias in ({', '.join('?' * len(chunk))})", chunk,
+            ).fetchall())
+        return [Room(*row) for row in rows]
+
+    def _write_rooms(self, query: str, params: Tuple, lookup_query: str, lookup_params: Tuple) -> List[Room]:
+        """Write to the rooms table and return the affected rooms as they are after the write"""
+        cursor = self.conn.execute(query, params)
+        self.conn.commit()
+        if lookup_params is None:
+            lookup_params = (cursor.lastrowid,)
+        return [Room(*row) for row in self.conn.execute(lookup_query, lookup_params).fetchall()]
+
+    async def _run(self, func: Callable, *args) -> Any:
+        """Run a function in the storage thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    def _execute(self, query: str, params: Tuple = ()) -> None:
+        self.conn.execute(query, params)
+        self.conn.commit()
+
+    def _executemany(self, query: str, params: List[Tuple]) -> None:
+        self.conn.executemany(query, params)
+        self.conn.commit()
+
+    def _fetchall(self, query: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        return self.conn.execute(query, params).fetchall()
+
+    def _fetchone(self, query: str, params: Tuple = ()) -> Optional[sqlite3.Row]:
+        return self.conn.execute(query, params).fetchone()
+
+    @asynccontextmanager
+    async def batch(self) -> AsyncIterator[StorageBatch]:
+        """Collect room writes and apply them with a single commit on exit
+
+        The writes are not applied if the block raises. Writes that fail are logged
+        without failing the other writes of the batch.
+        """
+        batch = StorageBatch()
+        yield batch
+        if batch.new_rooms or batch.room_ids:
+            rooms = await self._run(
+                self._write_room_batch,
+                list(batch.new_rooms.values()),
+                [(room_id, alias) for alias, room_id in batch.room_ids.items()],
+            )
+            for room in rooms:
+                self._cache_room(room)
+            logger.info(f"Stored {len(batch.new_rooms)} new rooms and {len(batch.room_ids)} room IDs")
 
-    def delete_recreate_room(self, room_id: str):
-        self.cursor.execute("""
+    async def delete_recreate_room(self, room_id: str):
+        await self._run(self._execute, """
             delete from recreate_rooms where room_id = ?;
         """, (room_id,))
-        self.conn.commit()
 
-    def get_breakout_room_id(self, event_id: str):
-        results = self.cursor.execute("""
-            select room_id from breakout_rooms where event_id = ?;
+    async def get_breakout_room(self, event_id: str) -> Optional[BreakoutRoom]:
+        if event_id not in self._breakout_event_ids:
+            return
+        row = await self._run(self._fetchone, """
+            select id, event_id, room_id from breakout_rooms where event_id = ?;
         """, (event_id,))
-        room = results.fetchone()
-        if room:
-            return room[0]
+        if row:
+            return BreakoutRoom(*row)
 
-    def get_encrypted_events(self, session_id: str):
-        results = self.cursor.execute("""
+    async def get_encrypted_events(self, session_id: str):
+        return await self._run(self._fetchall, """
             select * from encrypted_events where session_id = ?;
         """, (session_id,))
-        return results.fetchall()
 
-    def get_recreate_room(self, room_id: str):
-        results = self.cursor.execute("""
-            select requester, timestamp, applied from recreate_rooms where room_id = ?;
+    async def get_recreate_room(self, room_id: str) -> Optional[RecreateRequest]:
+        row = await self._run(self._fetchone, """
+            select id, requester, room_id, timestamp, applied from recreate_rooms where room_id = ?;
         """, (room_id,))
-        return results.fetchone()
+        if row:
+            return RecreateRequest(*row)
 
-    def get_room(self, room_id: str) -> Optional[sqlite3.Row]:
-        results = self.cursor.execute("""
-            select * from rooms where room_id = ?
-        """, (room_id,))
-        return results.fetchone()
+    async def get_room(self, room_id: str) -> Optional[Room]:
+        return self._rooms_by_room_id.get(room_id)
 
-    def get_room_by_alias(self, alias: str) -> Optional[sqlite3.Row]:
+    async def get_room_by_alias(self, alias: str) -> Optional[Room]:
         if alias.startswith("#"):
             localpart = alias.split(":")[0].strip("#")
         else:
             localpart = alias
-        results = self.cursor.execute("""
-            select id, name, alias, room_id, title, icon, encrypted, public, type from rooms where alias = ?
-        """, (localpart,))
-        return results.fetchone()
+        return self._rooms_by_alias.get(localpart)
 
-    def get_room_id(self, alias: str) -> Optional[str]:
-        results = self.cursor.execute("""
-            select room_id from rooms where alias = ?
-        """, (alias.split(":")[0].strip("#"),))
-        room = results.fetchone()
+    async def get_room_id(self, alias: str) -> Optional[str]:
+        room = self._rooms_by_alias.get(alias.split(":")[0].strip("#"))
         if room:
-            return room[0]
+            return room.room_id
 
-    def get_rooms(self, spaces=False) -> List[sqlite3.Row]:
-        query = "select * from rooms"
+    async def get_room_state(self, room_id: str, event_type: str) -> Optional[Tuple[Dict, int]]:
+        """Get the snapshot of a room state event
+
+        Returns a tuple of the event content and the timestamp the snapshot was stored at.
+        """
+        row = await self._run(self._fetchone, """
+            select content, timestamp from room_state where room_id = ? and type = ?
+        """, (room_id, event_type))
+        if row:
+            return json.loads(row["content"]), row["timestamp"]
+
+    async def get_rooms(self, spaces=False) -> List[Room]:
         if spaces:
-            query = f"{query} where type = 'space'"
-        results = self.cursor.execute(query)
-        return results.fetchall()
+            return [room for room in self._rooms.values() if room.type == "space"]
+        return list(self._rooms.values())
+
+    async def get_rooms_for_maintenance(self, sample_size: int) -> List[Room]:
+        """Get the rooms that should be maintained next
+
+        These are dirty rooms and rooms without a room ID, plus up to `sample_size`
+        clean rooms that were maintained the longest time ago.
+        """
+        rooms = []
+        clean = []
+        for room in self._rooms.values():
+            if room.dirty or not room.room_id:
+                rooms.append(room)
+            else:
+                clean.append(room)
+        clean.sort(key=lambda r: r.maintained_at)
+        return rooms + clean[:sample_size]
+
+    async def mark_rooms_dirty(self, room_ids: List[str]) -> None:
+        """Mark tracked rooms as needing maintenance"""
+        timestamp = int(time.time() * 1000)
+        rooms = [self._rooms_by_room_id[room_id] for room_id in room_ids if room_id in self._rooms_by_room_id]
+        if not rooms:
+            return
+        for room in rooms:
+            room.dirty = timestamp
+        await self._run(self._executemany, """
+            update rooms set dirty = ? where id = ?
+        """, [(timestamp, room.id) for room in rooms])
+
+    def _prune_encrypted_events(self, expire_before: int, max_events: int) -> int:
+        cursor = self.conn.execute("""
+            delete from encrypted_events where timestamp < ?;
+        """, (expire_before,))
+        removed = cursor.rowcount
+        cursor = self.conn.execute("""
+            delete from encrypted_events where id <= (
+                select id from encrypted_events order by id desc limit 1 offset ?
+            );
+        """, (max_events,))
+        removed += cursor.rowcount
+        self.conn.commit()
+        return removed
+
+    async def prune_encrypted_events(self, ttl: int, max_events: int) -> int:
+        """Remove stored undecryptable events older than ttl seconds or beyond the newest max_events
 
-    def remove_encrypted_event(self, event_id: str):
-        self.cursor.execute("""
+        Returns the number of events removed.
+        """
+        return await self._run(self._prune_encrypted_events, int(time.time()) - ttl, max_events)
+
+    async def remove_encrypted_event(self, event_id: str):
+        await self._run(self._execute, """
             delete from encrypted_events where event_id = ?;
         """, (event_id,))
-        self.conn.commit()
 
-    def set_recreate_room_applied(self, room_id: str):
-        self.cursor.execute("""
+    async def set_recreate_room_applied(self, room_id: str):
+        await self._run(self._execute, """
             update recreate_rooms set applied = 1 where room_id = ?; 
         """, (room_id,))
-        self.conn.commit()
 
-    def set_room_alias(self, room_id: str, alias: str) -> None:
-        self.cursor.execute("""
+    async def set_room_alias(self, room_id: str, alias: str) -> None:
+        rooms = await self._run(self._write_rooms, """
             update rooms set alias = ? where room_id = ?;
-        """, (alias.split(":")[0].strip("#"), room_id))
-        self.conn.commit()
+        """, (alias.split(":")[0].strip("#"), room_id), f"""
+            select {ROOM_COLUMNS} from rooms where room_id = ?
+        """, (room_id,))
+        for room in rooms:
+            self._cache_room(room)
 
-    def set_room_id(self, alias: str, room_id: str) -> None:
-        self.cursor.execute("""
+    async def set_room_id(self, alias: str, room_id: str) -> None:
+        localpart = alias.split(":")[0].strip("#")
+        rooms = await self._run(self._write_rooms, """
             update rooms set room_id = ? where alias = ?;
-        """, (room_id, alias.split(":")[0].strip("#")))
-        self.conn.commit()
+        """, (room_id, localpart), f"""
+            select {ROOM_COLUMNS} from rooms where alias = ?
+        """, (localpart,))
+        for room in rooms:
+            self._cache_room(room)
 
-    def store_breakout_room(self, event_id: str, room_id: str):
-        self.cursor.execute("""
+    async def set_room_ids(self, room_ids: Dict[str, str]) -> None:
+        """Set the room ID of many rooms, keyed by alias, with a single commit"""
+        pairs = [(room_id, alias.split(":")[0].strip("#")) for alias, room_id in room_ids.items()]
+        for room in await self._run(self._write_room_batch, [], pairs):
+            self._cache_room(room)
+
+    async def set_rooms_maintained(self, room_ids: List[str], started: int) -> None:
+        """Mark rooms as maintained by a maintenance pass that started at `started`
+
+        `started` is in milliseconds. Rooms marked dirty after the pass started stay dirty.
+        """
+        timestamp = int(time.time())
+        rooms = [self._rooms_by_room_id[room_id] for room_id in room_ids if room_id in self._rooms_by_room_id]
+        await self._run(self._executemany, """
+            update rooms set dirty = 0, maintained_at = ? where id = ? and dirty < ?
+        """, [(timestamp, room.id, started) for room in rooms])
+        for room in rooms:
+            if room.dirty < started:
+                room.dirty = 0
+                room.maintained_at = timestamp
+
+    async def store_breakout_room(self, event_id: str, room_id: str):
+        await self._run(self._execute, """
             insert into breakout_rooms
                 (event_id, room_id) values 
                 (?, ?);
         """, (event_id, room_id))
-        self.conn.commit()
+        self._breakout_event_ids.add(event_id)
+
+    async def store_encrypted_event(self, event: MegolmEvent):
+        """Store an undecryptable event for later decryption
 
-    def store_encrypted_event(self, event: MegolmEvent):
+        Only the event source is stored, which together with the room ID is all
+        MegolmEvent.from_dict needs to restore the event.
+        """
         try:
-            event_dict = asdict(event)
-            event_json = json.dumps(event_dict)
-            self.cursor.execute("""
+            event_json = json.dumps(event.source)
+            await self._run(self._execute, """
                 insert into encrypted_events
-                    (device_id, event_id, room_id, session_id, event) values
-                    (?, ?, ?, ?, ?)
-            """, (event.device_id, event.event_id, event.room_id, event.session_id, event_json))
-            self.conn.commit()
+                    (device_id, event_id, room_id, session_id, event, timestamp) values
+                    (?, ?, ?, ?, ?, ?)
+            """, (event.device_id, event.event_id, event.room_id, event.session_id, event_json, int(time.time())))
         except Exception as ex:
             logger.error("Failed to store encrypted event %s: %s" % (event.event_id, ex))
 
-    def store_recreate_room(self, requester: str, room_id: str):
+    async def store_recreate_room(self, requester: str, room_id: str):
         timestamp = int(time.time())
-        self.cursor.execute("""
+        await self._run(self._execute, """
             insert into recreate_rooms
                 (requester, room_id, timestamp) values 
                 (?, ?, ?);
         """, (requester, room_id, timestamp))
-        self.conn.commit()
 
-    def store_room(self, name, alias, room_id, title, encrypted, public, room_type):
-        self.cursor.execute("""
+    async def store_room(self, name, alias, room_id, title, encrypted, public, room_type):
+        rooms = await self._run(self._write_rooms, """
             insert into rooms (
                 name, alias, room_id, title, encrypted, public, type
             ) values (
                 ?, ?, ?, ?, ?, ?, ?
             )
-        """, (name, alias, room_id, title, encrypted, public, room_type))
-        self.conn.commit()
+        """, (name, alias, room_id, title, encrypted, public, room_type), f"""
+            select {ROOM_COLUMNS} from rooms where id = ?
+        """, None)
+        for room in rooms:
+            self._cache_room(room)
+
+    async def store_rooms(self, rooms: List[Tuple]) -> None:
+        """Store many rooms with a single commit
+
+        Each room is a tuple of name, alias, room_id, title, encrypted, public and type.
+        """
+        for room in await self._run(self._write_room_batch, rooms, []):
+            self._cache_room(room)
+
+    async def store_room_state(self, room_id: str, event_type: str, content: Dict) -> None:
+        await self.store_room_states([(room_id, event_type, content)])
 
-    def unlink_room(self, room_id: str):
-        self.cursor.execute("""
+    async def store_room_states(self, states: List[Tuple[str, str, Dict]]) -> None:
+        """Store snapshots of room state events
+
+        Each state is a tuple of room ID, event type and event content.
+        """
+        timestamp = int(time.time())
+        await self._run(self._executemany, """
+            insert or replace into room_state
+                (room_id, type, content, timestamp) values
+                (?, ?, ?, ?)
+        """, [(room_id, event_type, json.dumps(content), timestamp) for room_id, event_type, content in states])
+
+    def _unlink_room(self, room_id: str) -> None:
+        self.conn.execute("""
             delete from rooms where room_id = ?
         """, (room_id,))
+        self.conn.execute("""
+            delete from room_state where room_id = ?
+        """, (room_id,))
         self.conn.commit()
+
+    async def unlink_room(self, room_id: str):
+        await self._run(self._unlink_room, room_id)
+        room = self._rooms_by_room_id.get(room_id)
+        if room:
+            self._uncache_room(room.id)
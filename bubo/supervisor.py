@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+# noinspection PyPackageRequirements
+from aiohttp import ClientConnectionError, ServerDisconnectedError
+# noinspection PyPackageRequirements
+from nio import AsyncClient, SyncError, SyncResponse
+
+from bubo.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class SyncFailed(Exception):
+    """Raised from the sync loop when the homeserver answers a sync with an error"""
+    def __init__(self, response: SyncError):
+        super().__init__(f"{response.status_code}: {response.message}")
+        self.retry_after_ms = getattr(response, "retry_after_ms", None)
+
+
+# Failures the supervisor recovers from by reconnecting
+RECOVERABLE_ERRORS = (ClientConnectionError, ServerDisconnectedError, asyncio.TimeoutError, SyncFailed)
+
+
+class Supervisor:
+    """
+    Keeps the client syncing across homeserver outages.
+
+    Failed attempts are retried with exponential backoff and jitter. After
+    `failure_threshold` consecutive failures the circuit opens and no attempts are
+    made for `open_seconds`, after which a single attempt is made (half-open). A
+    successful sync closes the circuit again.
+
+    Startup, such as logging in and room maintenance, runs only until it succeeds once.
+    Reconnects resume syncing from the last sync token without requesting full state.
+    """
+    def __init__(self, config: Config):
+        self.initial_delay = config.reconnect_initial_delay
+        self.max_delay = config.reconnect_max_delay
+        self.failure_threshold = config.reconnect_failure_threshold
+        self.open_seconds = config.reconnect_open_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.reconnects = 0
+        self.failed_since: Optional[float] = None
+        self.retry_after: float = 0
+
+    def watch(self, client: AsyncClient):
+        """Follow sync responses of the client to track whether syncing works"""
+        # noinspection PyTypeChecker
+        client.add_response_callback(self.sync_succeeded, (SyncResponse,))
+        # noinspection PyTypeChecker
+        client.add_response_callback(self.sync_failed, (SyncError,))
+
+    async def sync_succeeded(self, _response: SyncResponse):
+        if self.failures:
+            logger.info(
+                "Syncing with homeserver again after %s failures in %.0fs",
+                self.failures, time.monotonic() - self.failed_since,
+            )
+        self.state = CLOSED
+        self.failures = 0
+        self.failed_since = None
+        self.retry_after = 0
+
+    @staticmethod
+    async def sync_failed(response: SyncError):
+        raise SyncFailed(response)
+
+    def record_failure(self, ex: Exception):
+        self.failures += 1
+        if self.failed_since is None:
+            self.failed_since = time.monotonic()
+        retry_after_ms = getattr(ex, "retry_after_ms", None)
+        self.retry_after = retry_after_ms / 1000 if retry_after_ms else 0
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.error(
+                    "Homeserver unreachable after %s attempts, not retrying for %ss: %s",
+                    self.failures, self.open_seconds, ex,
+                )
+            self.state = OPEN
+
+    def next_delay(self) -> float:
+        if self.state == OPEN:
+            return max(self.open_seconds, self.retry_after)
+        delay = min(self.max_delay, self.initial_delay * 2 ** (self.failures - 1))
+        # Equal jitter, so that many clients reconnecting after an outage spread out
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        return max(delay, self.retry_after)
+
+    async def run(self, start: Callable[[], Awaitable[bool]], sync: Callable[[bool], Awaitable]) -> bool:
+        """
+        Run `start` until it succeeds, then keep `sync` running.
+
+        `sync` is called with whether to request full state, which is only done on the
+        first sync. Returns False if `start` returns False, otherwise runs forever.
+        """
+        started = False
+        while True:
+            try:
+                if not started:
+                    if not await start():
+                        return False
+                    started = True
+                    await sync(True)
+                else:
+                    self.reconnects += 1
+                    await sync(False)
+            except RECOVERABLE_ERRORS as ex:
+                self.record_failure(ex)
+                delay = self.next_delay()
+                if self.state == OPEN:
+                    logger.warning("Circuit open, next reconnect attempt in %.0fs", delay)
+                else:
+                    logger.warning(
+                        "Unable to sync with homeserver (%s), retrying in %.1fs (attempt %s)",
+                        ex or type(ex).__name__, delay, self.failures,
+                    )
+                await asyncio.sleep(delay)
+                if self.state == OPEN:
+                    self.state = HALF_OPEN
@@ -1,12 +1,12 @@
 import asyncio
 import logging
 import time
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, AsyncIterator, Tuple
 from urllib.parse import quote_plus
 
-import aiohttp
-
+from bubo import cache
 from bubo.config import Config
+from bubo.http import request
 from bubo.utils import get_request_headers
 
 logger = logging.getLogger(__name__)
@@ -14,16 +14,27 @@ logger = logging.getLogger(__name__)
 API_PREFIX_V1 = "/_synapse/admin/v1"
 API_PREFIX_V2 = "/_synapse/admin/v2"
 
+# How long temporary user tokens are valid, in seconds
+TEMPORARY_TOKEN_VALIDITY = 60 * 15
+# Cached temporary tokens are not handed out when they expire sooner than this, in seconds
+TEMPORARY_TOKEN_EXPIRY_MARGIN = 60
 
-async def get_room(config: Config, session: aiohttp.ClientSession, room_id: str) -> Optional[Dict]:
-    headers = get_request_headers(config)
-    async with session.get(
-        f"{config.homeserver_url}{API_PREFIX_V1}/rooms/{room_id}",
-        headers=headers,
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await get_room(config, session, room_id)
+# Rooms fetched per request when listing all rooms on the server
+ROOM_LIST_PAGE_SIZE = 500
+
+
+async def get_room(config: Config, room_id: str) -> Optional[Dict]:
+    """
+    Get room details. Details are cached for a short while.
+    """
+    async def fetch() -> Optional[Dict]:
+        headers = get_request_headers(config)
+        response = await request(
+            "GET",
+            f"{config.homeserver_url}{API_PREFIX_V1}/rooms/{room_id}",
+            "admin",
+            headers=headers,
+        )
         try:
             response.raise_for_status()
             return await response.json()
@@ -31,20 +42,68 @@ async def get_room(config: Config, session: aiohttp.ClientSession, room_id: str)
             logger.warning("Failed to get room %s: %s", room_id, ex)
             return
 
+    return await cache.room_details.get(room_id, fetch)
 
-async def get_temporary_user_token(
-    config: Config, session: aiohttp.ClientSession, headers: Dict, user: str,
-) -> Optional[str]:
-    async with session.post(
-        f"{config.homeserver_url}{API_PREFIX_V1}/users/{user}/login",
-        json={
-            "valid_until_ms": (int(time.time()) + 60*15) * 1000,  # 15 minutes
-        },
-        headers=headers,
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await get_temporary_user_token(config, session, headers, user)
+
+async def get_room_list(config: Config, max_requests: Optional[int] = None) -> Dict[str, Dict]:
+    """
+    Get details of all rooms on the server, paginating through the room list.
+
+    Returns a map of room ID to the room list entry, which includes among others the name,
+    canonical alias, joined member count, encryption and join rules of the room. If listing
+    all rooms would take more than `max_requests` requests, only the first page is returned.
+    """
+    headers = get_request_headers(config)
+    rooms = {}
+    start = 0
+    requests_made = 0
+    while True:
+        response = await request(
+            "GET",
+            f"{config.homeserver_url}{API_PREFIX_V1}/rooms",
+            "admin",
+            params={
+                "from": start,
+                "limit": ROOM_LIST_PAGE_SIZE,
+            },
+            headers=headers,
+        )
+        requests_made += 1
+        try:
+            response.raise_for_status()
+            data = await response.json()
+        except Exception as ex:
+            logger.warning("Failed to get room list from %s: %s", start, ex)
+            return rooms
+        for room in data.get("rooms", []):
+            rooms[room["room_id"]] = room
+        if data.get("next_batch") is None:
+            return rooms
+        if max_requests is not None and requests_made == 1:
+            total_requests = -(-data.get("total_rooms", 0) // ROOM_LIST_PAGE_SIZE)
+            if total_requests > max_requests:
+                logger.debug("Not listing all %s rooms, would take %s requests", data.get("total_rooms"), total_requests)
+                return rooms
+        start = data["next_batch"]
+
+
+async def get_temporary_user_token(config: Config, headers: Dict, user: str) -> Optional[str]:
+    """
+    Get a temporary access token for a user.
+
+    Tokens are cached and reused until shortly before they expire.
+    """
+    async def fetch() -> Optional[str]:
+        valid_until_ms = (int(time.time()) + TEMPORARY_TOKEN_VALIDITY) * 1000
+        response = await request(
+            "POST",
+            f"{config.homeserver_url}{API_PREFIX_V1}/users/{user}/login",
+            "admin",
+            json={
+                "valid_until_ms": valid_until_ms,
+            },
+            headers=headers,
+        )
         try:
             response.raise_for_status()
             data = await response.json()
@@ -53,98 +112,153 @@ async def get_temporary_user_token(
             logger.warning("Failed to get temporary access token for user %s: %s", user, ex)
             return
 
+    return await cache.temporary_tokens.get(
+        user, fetch, ttl=TEMPORARY_TOKEN_VALIDITY - TEMPORARY_TOKEN_EXPIRY_MARGIN,
+    )
+
+
+async def get_rooms(config: Config, room_ids: List[str], batch_size: int = 50) -> AsyncIterator[List[Dict]]:
+    """
+    Fetch room details for the given rooms concurrently.
 
-async def get_user_rooms(config: Config, user_id: str) -> List:
+    For many rooms, details are first taken from the server room list if paging through it
+    takes fewer round trips than fetching each room concurrently. Remaining rooms are fetched with at most
+    `matrix.synapse_admin_concurrency` requests in flight at a time. Rooms are yielded in
+    batches of `batch_size`, in the same order as `room_ids`. Rooms whose details cannot be
+    fetched are yielded with only the room ID.
+    """
+    listed = {}
+    max_requests = len(room_ids) // config.synapse_admin_concurrency
+    if max_requests:
+        listed = await get_room_list(config, max_requests=max_requests)
+    semaphore = asyncio.Semaphore(config.synapse_admin_concurrency)
+
+    async def fetch(room_id: str) -> Dict:
+        if room_id in listed:
+            return listed[room_id]
+        async with semaphore:
+            room = await get_room(config, room_id)
+        return room or {
+            "room_id": room_id,
+        }
+
+    tasks = [asyncio.ensure_future(fetch(room_id)) for room_id in room_ids]
+    try:
+        batch = []
+        for task in tasks:
+            batch.append(await task)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def get_user_joined_room_ids(config: Config, user_id: str) -> List[str]:
     headers = get_request_headers(config)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"{config.homeserver_url}{API_PREFIX_V1}/users/{user_id}/joined_rooms",
-            headers=headers,
-        ) as response:
-            if response.status == 429:
-                await asyncio.sleep(1)
-                return await get_user_rooms(config, user_id)
-            try:
-                response.raise_for_status()
-                data = await response.json()
-            except Exception as ex:
-                logger.warning("Failed to get user rooms for user %s: %s", user_id, ex)
-                return []
-        rooms = []
-        for room_id in data.get("joined_rooms", []):
-            room = await get_room(config, session, room_id)
-            if room:
-                rooms.append(room)
-            else:
-                rooms.append({
-                    "room_id": room_id,
-                })
-        return rooms
+    response = await request(
+        "GET",
+        f"{config.homeserver_url}{API_PREFIX_V1}/users/{user_id}/joined_rooms",
+        "admin",
+        headers=headers,
+    )
+    try:
+        response.raise_for_status()
+        data = await response.json()
+    except Exception as ex:
+        logger.warning("Failed to get user rooms for user %s: %s", user_id, ex)
+        return []
+    return data.get("joined_rooms", [])
 
 
 async def get_temporary_user_tokens(config: Config, users: List[str]) -> Dict:
     headers = get_request_headers(config)
     tokens = {}
-    async with aiohttp.ClientSession() as session:
-        for user in users:
-            token = await get_temporary_user_token(config, session, headers, user)
-            if token:
-                logger.debug("Got temporary token for user %s", user)
-                tokens[user] = token
-            else:
-                logger.debug("Failed to get temporary token for user %s", user)
+    semaphore = asyncio.Semaphore(config.synapse_admin_concurrency)
+
+    async def get_token(user: str):
+        async with semaphore:
+            token = await get_temporary_user_token(config, headers, user)
+        if token:
+            logger.debug("Got temporary token for user %s", user)
+            tokens[user] = token
+        else:
+            logger.debug("Failed to get temporary token for user %s", user)
+
+    await asyncio.gather(*(get_token(user) for user in users))
     return tokens
 
 
 async def join_user(
-    config: Config, headers: Dict, room_id_or_alias: str, session: aiohttp.ClientSession, user: str,
-) -> bool:
-    async with session.post(
+    config: Config, headers: Dict, room_id_or_alias: str, user: str,
+) -> Tuple[bool, Optional[str]]:
+    """
+    Force join a user to a room.
+
+    Returns whether the join succeeded and the reason if it did not.
+    """
+    response = await request(
+        "POST",
         f"{config.homeserver_url}{API_PREFIX_V1}/join/{quote_plus(room_id_or_alias)}",
+        "admin",
         json={
             "user_id": user,
         },
         headers=headers,
-    ) as response:
-        if response.status == 429:
-            await asyncio.sleep(1)
-            return await join_user(config, headers, room_id_or_alias, session, user)
-        try:
-            response.raise_for_status()
-            return True
-        except Exception as ex:
-            logger.warning("Failed to join user %s: %s", user, ex)
-            return False
+    )
+    if response.status < 400:
+        return True, None
+    try:
+        data = await response.json()
+        reason = data.get("error") or data.get("errcode")
+    except Exception:
+        reason = None
+    reason = reason or f"HTTP {response.status} {response.reason}"
+    logger.warning("Failed to join user %s: %s", user, reason)
+    return False, reason
+
 
+async def join_users(config: Config, users: List[str], room_id_or_alias: str) -> Dict[str, Optional[str]]:
+    """
+    Force join users to a room concurrently.
 
-async def join_users(config: Config, users: List[str], room_id_or_alias: str) -> int:
+    At most `matrix.synapse_admin_concurrency` joins are in flight at a time. Returns the
+    outcome per user, None for users who were joined, otherwise the reason the join failed.
+    """
     headers = get_request_headers(config)
+    semaphore = asyncio.Semaphore(config.synapse_admin_concurrency)
+    results = {}
+
+    async def join(user: str):
+        async with semaphore:
+            try:
+                joined, reason = await join_user(config, headers, room_id_or_alias, user)
+            except Exception as ex:
+                logger.warning("Failed to join user %s: %s", user, ex)
+                joined, reason = False, str(ex) or type(ex).__name__
+        results[user] = None if joined else reason
 
-    total_joined = 0
-    async with aiohttp.ClientSession() as session:
-        for user in users:
-            result = await join_user(config, headers, room_id_or_alias, session, user)
-            if result:
-                total_joined += 1
-        return total_joined
+    await asyncio.gather(*(join(user) for user in users))
+    return results
 
 
 async def make_room_admin(config: Config, room_id: str, user_id: str) -> bool:
     headers = get_request_headers(config)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-                f"{config.homeserver_url}{API_PREFIX_V1}/rooms/{room_id}/make_room_admin",
-                json={
-                    "user_id": user_id,
-                },
-                headers=headers,
-        ) as response:
-            if response.status == 429:
-                await asyncio.sleep(1)
-                return await make_room_admin(config, room_id, user_id)
-            try:
-                response.raise_for_status()
-                return True
-            except Exception as ex:
-                logger.warning("Failed to make room admin in %s for %s: %s", room_id, user_id, ex)
-                return False
+    response = await request(
+        "POST",
+        f"{config.homeserver_url}{API_PREFIX_V1}/rooms/{room_id}/make_room_admin",
+        "admin",
+        json={
+            "user_id": user_id,
+        },
+        headers=headers,
+    )
+    try:
+        response.raise_for_status()
+        return True
+    except Exception as ex:
+        logger.warning("Failed to make room admin in %s for %s: %s", room_id, user_id, ex)
+        return False
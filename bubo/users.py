@@ -1,7 +1,6 @@
 import json
 from typing import List, Dict, Optional
 
-import requests
 # noinspection PyPackageRequirements
 from keycloak import KeycloakAdmin
 
@@ -9,6 +8,7 @@ from bubo.config import Config
 from bubo.emails import send_plain_email
 from bubo.email_strings import INVITE_LINK_EMAIL
 from bubo.errors import ConfigError
+from bubo.metrics import metrics, timed_request
 
 
 def get_admin_client(config: Config) -> KeycloakAdmin:
@@ -18,13 +18,16 @@ def get_admin_client(config: Config) -> KeycloakAdmin:
         "client_secret_key": config.keycloak["client_secret_key"],
         "verify": True,
     }
-    return KeycloakAdmin(**params)
+    with metrics.timed("keycloak", "login"):
+        return KeycloakAdmin(**params)
 
 
 def create_signup_link(config: Config, creator: str, max_signups: int, days_valid: int) -> str:
     if not config.keycloak_signup.get('enabled'):
         raise ConfigError("Keycloak-Signup not configured")
-    response = requests.post(
+    response = timed_request(
+        "keycloak_signup",
+        "POST",
         f"{config.keycloak_signup.get('url')}/api/pages",
         json={
             "creator": creator,
@@ -45,19 +48,22 @@ def create_user(config: Config, username: str, email: str) -> Optional[str]:
     if not config.keycloak.get('enabled'):
         return
     keycloak_admin = get_admin_client(config)
-    return keycloak_admin.create_user({
-        "email": email,
-        "emailVerified": True,
-        "enabled": True,
-        "username": username,
-    })
+    with metrics.timed("keycloak", "create_user"):
+        return keycloak_admin.create_user({
+            "email": email,
+            "emailVerified": True,
+            "enabled": True,
+            "username": username,
+        })
 
 
 def invite_user(config: Config, email: str, creator: str):
     if not config.keycloak_signup.get('enabled'):
         return
     # Create page
-    response = requests.post(
+    response = timed_request(
+        "keycloak_signup",
+        "POST",
         f"{config.keycloak_signup.get('url')}/api/pages",
         json={
             "creator": creator,
@@ -83,19 +89,21 @@ def send_password_reset(config: Config, user_id: str) -> Dict:
     if not config.keycloak.get('enabled'):
         return {}
     keycloak_admin = get_admin_client(config)
-    keycloak_admin.send_update_account(
-        user_id=user_id,
-        payload=json.dumps(['UPDATE_PASSWORD']),
-    )
+    with metrics.timed("keycloak", "send_update_account"):
+        keycloak_admin.send_update_account(
+            user_id=user_id,
+            payload=json.dumps(['UPDATE_PASSWORD']),
+        )
 
 
 def get_user_by_attr(config: Config, attr: str, value: str) -> Optional[Dict]:
     if not config.keycloak.get('enabled'):
         return
     keycloak_admin = get_admin_client(config)
-    users = keycloak_admin.get_users({
-        attr: value,
-    })
+    with metrics.timed("keycloak", "get_users"):
+        users = keycloak_admin.get_users({
+            attr: value,
+        })
     if len(users) == 1:
         return users[0]
     elif len(users) > 1:
@@ -106,5 +114,6 @@ def list_users(config: Config) -> List[Dict]:
     if not config.keycloak.get('enabled'):
         return []
     keycloak_admin = get_admin_client(config)
-    users = keycloak_admin.get_users({})
+    with metrics.timed("keycloak", "get_users"):
+        users = keycloak_admin.get_users({})
     return users
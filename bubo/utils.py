@@ -1,10 +1,14 @@
+import asyncio
 import logging
-import time
-from typing import Set
+from copy import deepcopy
+from typing import Dict, Optional, Set, Union
 
 # noinspection PyPackageRequirements
-from nio import AsyncClient, JoinedMembersResponse, RoomResolveAliasError, ProtocolError
+from nio import (
+    AsyncClient, ErrorResponse, JoinedMembersResponse, MatrixRoom, RoomMember, RoomResolveAliasError, ProtocolError,
+)
 
+from bubo import cache
 from bubo.config import Config
 
 logger = logging.getLogger(__name__)
@@ -19,6 +23,56 @@ async def ensure_room_id(client: AsyncClient, room_id_or_alias: str) -> str:
     return room_id_or_alias
 
 
+def get_synced_room(client: AsyncClient, room_id: str) -> Optional[MatrixRoom]:
+    """
+    Get a room Bubo is joined to from the matrix-nio store.
+
+    Bubo syncs without lazy loading members, so once a room has appeared in a sync, its
+    state and members in the store are complete and kept up to date by later syncs.
+    """
+    room = client.rooms.get(room_id)
+    if room and client.user_id in room.users and client.user_id not in room.invited_users:
+        return room
+
+
+def get_synced_power_levels(client: AsyncClient, room_id: str) -> Optional[Dict]:
+    """
+    Get the power levels content of a room Bubo is joined to as delivered by sync, if known.
+
+    The raw event content is used rather than matrix-nio's parsed power levels, which
+    drop unknown keys and fill in defaults.
+    """
+    if not get_synced_room(client, room_id) or (room_id, "m.room.power_levels") in cache.unsynced_state:
+        return None
+    content = cache.synced_power_levels.get(room_id)
+    if content is not None:
+        # Callers are free to modify the content, so don't hand out the cached copy
+        return deepcopy(content)
+
+
+async def get_joined_members(client: AsyncClient, room_id: str) -> Union[JoinedMembersResponse, ErrorResponse]:
+    """
+    Get the joined members of a room.
+
+    Members of rooms Bubo is joined to come from the matrix-nio store. For other rooms
+    they are fetched from the homeserver and successful responses cached for a short while.
+    """
+    room = get_synced_room(client, room_id)
+    if room:
+        return JoinedMembersResponse(
+            members=[
+                RoomMember(user.user_id, user.display_name, user.avatar_url)
+                for user in room.users.values() if user.user_id not in room.invited_users
+            ],
+            room_id=room_id,
+        )
+    return await cache.joined_members.get(
+        room_id,
+        lambda: client.joined_members(room_id),
+        cache_if=lambda response: isinstance(response, JoinedMembersResponse),
+    )
+
+
 def get_request_headers(config):
     return {
         "Authorization": f"Bearer {config.user_token}",
@@ -39,7 +93,7 @@ async def get_users_for_access(client: AsyncClient, config: Config, access_type:
     for room_id in existing_list:
         if not room_id.startswith("!"):
             continue
-        response = await with_ratelimit(client=client, method="joined_members", room_id=room_id)
+        response = await get_joined_members(client, room_id)
         if isinstance(response, JoinedMembersResponse):
             logger.debug(f"Found {len(response.members)} users for {access_type} access type in room {room_id}")
             users.extend([member.user_id for member in response.members])
@@ -48,12 +102,13 @@ async def get_users_for_access(client: AsyncClient, config: Config, access_type:
     return set(users)
 
 
-# TODO remove usage of this wrapper for any matrix-nio calls
-# Reading that code it seems it already handles rate limits 😅
-async def with_ratelimit(client: AsyncClient, method: str, *args, **kwargs):
-    func = getattr(client, method)
-    response = await func(*args, **kwargs)
-    if getattr(response, "status_code", None) == "M_LIMIT_EXCEEDED":
-        time.sleep(3)
-        return with_ratelimit(client, method, *args, **kwargs)
-    return response
+async def get_access_sets(client: AsyncClient, config: Config) -> Dict[str, Set]:
+    """
+    Resolve the users of every access type at once.
+
+    Meant for work on many rooms, which can then check access against the returned
+    sets instead of looking up the members of configured access rooms for each room.
+    """
+    access_types = ("admins", "coordinators", "pindora_users")
+    results = await asyncio.gather(*(get_users_for_access(client, config, access_type) for access_type in access_types))
+    return dict(zip(access_types, results))
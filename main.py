@@ -1,17 +1,10 @@
 #!/usr/bin/env python3
 import logging
-from time import sleep
 
 import aiolog
 import asyncio
 # noinspection PyPackageRequirements
-from aiohttp import (
-    ServerDisconnectedError,
-    ClientConnectionError
-)
-# noinspection PyPackageRequirements
 from nio import (
-    AsyncClient,
     AsyncClientConfig,
     ForwardedRoomKeyEvent,
     InviteMemberEvent,
@@ -20,20 +13,43 @@ from nio import (
     MegolmEvent,
     RoomKeyEvent,
     RoomMessageText,
+    SyncResponse,
     UnknownEvent,
 )
 
+from bubo import cache
 from bubo.callbacks import Callbacks
+from bubo.client import Client
 from bubo.config import Config, load_config
-from bubo.rooms import maintain_configured_rooms
+from bubo.http import sessions
+from bubo.maintenance import scheduler
+from bubo.metrics import start_server as start_metrics_server
+from bubo.ratelimit import limiter
 from bubo.storage import Storage
+from bubo.supervisor import Supervisor
 
 logger = logging.getLogger(__name__)
 
 
+async def prune_encrypted_events(store: Storage, config: Config):
+    """Periodically remove expired undecryptable events from the database"""
+    while True:
+        try:
+            removed = await store.prune_encrypted_events(config.encrypted_events_ttl, config.encrypted_events_max)
+            if removed:
+                logger.info(f"Pruned {removed} stored undecryptable events")
+        except Exception as ex:
+            logger.warning(f"Failed to prune stored undecryptable events: {ex}")
+        await asyncio.sleep(config.encrypted_events_prune_interval)
+
+
 async def main(config: Config):
     # Configure the database
     store = Storage(config.database_filepath)
+    # Shared connection pool for HTTP calls made outside matrix-nio
+    sessions.configure(config)
+    limiter.configure(config)
+    cache.configure(config)
 
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
@@ -44,7 +60,7 @@ async def main(config: Config):
     )
 
     # Initialize the matrix client
-    client = AsyncClient(
+    client = Client(
         config.homeserver_url,
         config.user_id,
         device_id=config.device_id,
@@ -68,56 +84,69 @@ async def main(config: Config):
     client.add_event_callback(callbacks.reaction, (UnknownEvent,))
     # noinspection PyTypeChecker
     client.add_to_device_callback(callbacks.room_key, (ForwardedRoomKeyEvent, RoomKeyEvent))
-
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            if config.user_token:
-                client.load_store()
-            else:
-                # Try to login with the configured username/password
-                try:
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
-
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        logger.error(f"Failed to login: %s", login_response.message)
-                        return False
-                except LocalProtocolError as e:
-                    # There's an edge case here where the user hasn't installed the correct C
-                    # dependencies. In that case, a LocalProtocolError is raised on login.
-                    logger.fatal(
-                        "Failed to login. Have you installed the correct dependencies? "
-                        "https://github.com/poljar/matrix-nio#installation "
-                        "Error: %s", e
-                    )
+    # noinspection PyTypeChecker
+    client.add_response_callback(callbacks.sync, (SyncResponse,))
+
+    async def start() -> bool:
+        if config.user_token:
+            client.load_store()
+        else:
+            # Try to login with the configured username/password
+            try:
+                login_response = await client.login(
+                    password=config.user_password,
+                    device_name=config.device_name,
+                )
+
+                # Check if login failed
+                if type(login_response) == LoginError:
+                    logger.error(f"Failed to login: %s", login_response.message)
                     return False
-
-                # Login succeeded!
-
-            # Sync encryption keys with the server
-            # Required for participating in encrypted rooms
-            if client.should_upload_keys:
-                await client.keys_upload()
-
-            # Maintain rooms
-            await maintain_configured_rooms(client, store, config)
-
-            logger.info(f"Logged in as {config.user_id}")
-            await client.sync_forever(timeout=30000, full_state=True)
-
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
-
+            except LocalProtocolError as e:
+                # There's an edge case here where the user hasn't installed the correct C
+                # dependencies. In that case, a LocalProtocolError is raised on login.
+                logger.fatal(
+                    "Failed to login. Have you installed the correct dependencies? "
+                    "https://github.com/poljar/matrix-nio#installation "
+                    "Error: %s", e
+                )
+                return False
+
+            # Login succeeded!
+
+        # Sync encryption keys with the server
+        # Required for participating in encrypted rooms
+        if client.should_upload_keys:
+            await client.keys_upload()
+
+        # Maintain rooms in the background, so that commands are handled right away
+        scheduler.start(client, store, config)
+
+        logger.info(f"Logged in as {config.user_id}")
+        return True
+
+    async def sync(full_state: bool):
+        # Without full state, syncing continues from the last sync token
+        await client.sync_forever(timeout=30000, full_state=full_state or None)
+
+    # Keep reconnecting on failure, backing off while the homeserver is unavailable
+    supervisor = Supervisor(config)
+    supervisor.watch(client)
+    pruning_task = None
+    metrics_runner = None
+    try:
+        # Keep a reference so the task isn't garbage collected
+        pruning_task = asyncio.ensure_future(prune_encrypted_events(store, config))
+        metrics_runner = await start_metrics_server(config)
+        return await supervisor.run(start, sync)
+    finally:
+        await scheduler.stop()
+        if pruning_task:
+            pruning_task.cancel()
+        await client.close()
+        await sessions.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 config_file = load_config()
 